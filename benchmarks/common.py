@@ -0,0 +1,84 @@
+"""
+Helpers shared by the benchmark scripts in this directory
+
+The scripts do not need a Django project, a minimal configuration is
+created here. Run them from the repository root::
+
+    python benchmarks/formats.py
+"""
+
+import datetime
+import decimal
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+            }},
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth'],
+        ROOT_URLCONF=__name__,
+        USE_I18N=True,
+        )
+
+from django.utils.translation import ugettext_lazy
+
+urlpatterns = []
+
+
+def synthetic_page(size=100, native=False):
+    """
+    Returns a dictionary looking like a serialized list page of
+    ``towel.api.Resource``. Dates, decimals and lazy translation strings
+    are included unless ``native`` is ``True``; these are replaced by
+    their JSON representation in that case.
+    """
+    objects = []
+    for i in range(size):
+        created = datetime.datetime(2012, 1, 1, 12, 30) + datetime.timedelta(hours=i)
+        price = decimal.Decimal('%s.95' % i)
+        status = ugettext_lazy('active')
+
+        objects.append({
+            '__uri__': '/api/v1/product/%s/' % i,
+            '__unicode__': u'Product \xe9 %s' % i,
+            '__pretty__': {'status': status if not native else u'active'},
+            'id': i,
+            'name': u'Product %s' % i,
+            'description': u'Lorem ipsum dolor sit amet ' * 4,
+            'category': '/api/v1/category/%s/' % (i % 10),
+            'status': 1,
+            'is_active': bool(i % 2),
+            'price': price if not native else str(price),
+            'created': created if not native else created.isoformat(),
+            'updated': created.date() if not native else created.date().isoformat(),
+            })
+
+    return {
+        'objects': objects,
+        'meta': {
+            'offset': 0,
+            'limit': size,
+            'total': size * 10,
+            'next': '/api/v1/product/?offset=%s&limit=%s' % (size, size),
+            },
+        }
+
+
+def measure(function, number=None):
+    """
+    Returns the time per call of ``function`` in milliseconds
+    """
+    timer = timeit.Timer(function)
+    if number is None:
+        number = 1
+        while timer.timeit(number) < 0.2:
+            number *= 2
+    return min(timer.repeat(3, number)) / number * 1000
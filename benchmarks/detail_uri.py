@@ -0,0 +1,45 @@
+"""
+Cost of the ``__uri__`` of serialized objects
+
+Compares reversing the detail URI of every object using ``api_reverse``
+(as serializers did before) with ``API.detail_uri``, which reverses once
+per model and formats a cached template afterwards. Checks that both
+produce the same URIs.
+"""
+
+from common import measure, urlpatterns
+
+from django.conf.urls import include, url
+from django.core.urlresolvers import set_script_prefix
+from django.contrib.auth.models import Group
+
+from towel.api import API, api_reverse
+
+
+def main():
+    api = API('v1')
+    api.register(Group, view_init={'model': Group})
+    urlpatterns.append(url(r'^api/v1/', include(api.urls)))
+
+    assert api.detail_uri(Group, 1) == '/api/v1/group/1/'
+    set_script_prefix('/mounted/')
+    assert api.detail_uri(Group, 1) == '/mounted/api/v1/group/1/'
+    set_script_prefix('/')
+    for pk in (1, 42, 10 ** 12, u'1'):
+        assert api.detail_uri(Group, pk) == api_reverse(Group, 'detail',
+            api_name=api.name, pk=pk, fail_silently=True), (
+            'URIs for %r differ' % pk)
+
+    print '%-14s %6s %12s' % ('method', 'rows', 'ms/page')
+
+    for size in (20, 100, 1000):
+        pks = range(1, size + 1)
+        print '%-14s %6s %12.3f' % ('api_reverse', size, measure(lambda: [
+            api_reverse(Group, 'detail', api_name=api.name, pk=pk,
+                fail_silently=True) for pk in pks]))
+        print '%-14s %6s %12.3f' % ('detail_uri', size, measure(lambda: [
+            api.detail_uri(Group, pk) for pk in pks]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Size and encoding speed of the response formats of ``towel.api``
+
+Encodes synthetic list pages using every registered format and reports the
+size of the encoded page and the time needed to encode it. Checks that
+MessagePack transports the same data (text strings, not bytes) as JSON.
+"""
+
+from common import measure, synthetic_page
+
+from towel import api
+
+
+def contains_bytes(data):
+    """
+    Returns whether decoded MessagePack data contains byte strings (strings
+    decode to ``unicode`` with ``raw=False``, binary data to ``str``)
+    """
+    if isinstance(data, dict):
+        return any(contains_bytes(key) or contains_bytes(value)
+            for key, value in data.items())
+    elif isinstance(data, (list, tuple)):
+        return any(contains_bytes(value) for value in data)
+    return isinstance(data, str)
+
+
+def main():
+    try:
+        import msgpack
+    except ImportError:
+        msgpack = None
+
+    print '%-24s %6s %10s %10s' % ('format', 'rows', 'bytes', 'ms/page')
+
+    for size in (20, 100, 1000):
+        page = synthetic_page(size)
+
+        for mimetype, handler in api.FORMATS:
+            content = handler(page).content
+            print '%-24s %6s %10s %10.3f' % (mimetype, size, len(content),
+                measure(lambda: handler(page).content))
+
+            if mimetype == 'application/x-msgpack':
+                data = msgpack.unpackb(content, raw=False)
+                assert not contains_bytes(data), 'MessagePack contains bytes'
+                assert data == api.json.loads(api.json_response(page).content), (
+                    'MessagePack and JSON differ')
+
+    if msgpack is None:
+        print 'msgpack is not installed, MessagePack was not benchmarked.'
+
+
+if __name__ == '__main__':
+    main()
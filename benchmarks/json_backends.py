@@ -0,0 +1,58 @@
+"""
+Encoding speed of the JSON backends of ``towel.api``
+
+Encodes synthetic list pages containing dates, decimals and lazy
+translation strings using every registered JSON backend (see
+``towel.api.register_json_backend``) and the ``DjangoJSONEncoder`` based
+encoding used before the backends were introduced. Checks that every
+backend produces the same data as the ``json`` backend.
+
+Django 1.4 bases ``DjangoJSONEncoder`` on ``simplejson`` if it is
+installed, which encodes decimals as numbers instead of strings; its
+output is not compared.
+"""
+
+from common import measure, synthetic_page
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import force_unicode
+from django.utils.functional import Promise
+
+from towel import api
+
+
+class LazyJSONEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder does not handle lazy translation strings
+    def default(self, o):
+        if isinstance(o, Promise):
+            return force_unicode(o)
+        return super(LazyJSONEncoder, self).default(o)
+
+
+def main():
+    encoders = [('DjangoJSONEncoder',
+        lambda data: api.json.dumps(data, cls=LazyJSONEncoder))]
+    encoders.extend(sorted(api.JSON_BACKENDS.items()))
+
+    print '%-20s %6s %10s %10s' % ('backend', 'rows', 'ms/page', 'speedup')
+
+    for size in (20, 100, 1000):
+        page = synthetic_page(size)
+        expected = api.json.loads(api.JSON_BACKENDS['json'](page))
+        baseline = None
+
+        for name, dumps in encoders:
+            if name in api.JSON_BACKENDS:
+                assert api.json.loads(dumps(page)) == expected, (
+                    '%s produces different data' % name)
+
+            time = measure(lambda: dumps(page))
+            baseline = baseline or time
+            print '%-20s %6s %10.3f %9.2fx' % (name, size, time, baseline / time)
+
+    if 'simplejson' not in api.JSON_BACKENDS:
+        print 'simplejson is not installed, it was not benchmarked.'
+
+
+if __name__ == '__main__':
+    main()
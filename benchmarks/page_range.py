@@ -0,0 +1,103 @@
+"""
+Correctness and speed of ``towel.paginator.Page.page_range``
+
+Compares the page ranges generated by ``towel.paginator`` with those of the
+original implementation (which visited every page) for many combinations
+of the ``PAGINATION`` setting, including ``END = 0``, and for paginators
+which stopped counting at ``count_ceiling``. Reports the time needed to
+generate the page range for growing numbers of pages afterwards.
+"""
+
+import itertools
+
+from common import measure
+
+from django.core import paginator as django_paginator
+
+from towel import paginator
+
+
+def filter_adjacent(iterable):
+    current = object()
+    for item in iterable:
+        if item != current:
+            current = item
+            yield item
+
+
+def reference_page_range(num_pages, number, exceeded=False):
+    """
+    The original implementation of ``Page._generate_page_range``, generating
+    one item for every page. If counting stopped at the ceiling the last
+    pages are unknown, those are replaced by an ellipsis.
+    """
+    config = paginator.PAGINATION
+    end = 0 if exceeded else config['END']
+
+    def generate():
+        for i in range(1, num_pages + 1):
+            if i <= config['START']:
+                yield i
+            elif i > num_pages - end:
+                yield i
+            elif abs(number - i) <= config['AROUND']:
+                yield i
+            else:
+                yield None # Ellipsis marker
+
+        if exceeded:
+            yield None
+
+    return list(filter_adjacent(generate()))
+
+
+class FakePaginator(object):
+    def __init__(self, num_pages, exceeded=False):
+        self.num_pages = num_pages
+        self.count_exceeded = exceeded
+
+
+def page_range(num_pages, number, exceeded=False):
+    page = paginator.Page(django_paginator.Page([], number,
+        FakePaginator(num_pages, exceeded)))
+    return list(page.page_range)
+
+
+def main():
+    original = dict(paginator.PAGINATION)
+    cases = 0
+
+    try:
+        for start, end, around in itertools.product(range(5), repeat=3):
+            paginator.PAGINATION.update(START=start, END=end, AROUND=around)
+
+            for num_pages in range(1, 30):
+                for number in range(1, num_pages + 1):
+                    for exceeded in (False, True):
+                        expected = reference_page_range(num_pages, number, exceeded)
+                        result = page_range(num_pages, number, exceeded)
+                        assert result == expected, (
+                            'START=%s END=%s AROUND=%s, %s pages, page %s%s: '
+                            '%r instead of %r' % (start, end, around, num_pages,
+                                number, ', exceeded' if exceeded else '',
+                                result, expected))
+                        cases += 1
+    finally:
+        paginator.PAGINATION.clear()
+        paginator.PAGINATION.update(original)
+
+    print 'Page ranges identical in %s cases.' % cases
+    print
+    print '%10s %14s %14s' % ('pages', 'original ms', 'towel ms')
+
+    for num_pages in (10, 1000, 100000):
+        number = num_pages // 2
+        page = paginator.Page(django_paginator.Page([], number,
+            FakePaginator(num_pages)))
+        print '%10s %14.4f %14.4f' % (num_pages,
+            measure(lambda: reference_page_range(num_pages, number)),
+            measure(lambda: list(page.page_range)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,52 @@
-from collections import namedtuple
+import base64
+from calendar import timegm
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from cStringIO import StringIO
+import csv
+import datetime
+import decimal
+import hashlib
 import json
+import logging
+import math
 import mimeparse
 import operator
+import re
+import socket
+import time
+import types
 from urllib import urlencode
+import warnings
 
+from django.conf import settings
 from django.conf.urls import patterns, include, url
+from django.core.cache import get_cache
+from django.core.exceptions import ValidationError
 from django.core.serializers.json import DjangoJSONEncoder
-from django.core.urlresolvers import NoReverseMatch, reverse
-from django.http import Http404, HttpResponse
+from django.core.urlresolvers import get_script_prefix, NoReverseMatch, reverse
+from django.db import connections, transaction
+from django.db.models import FieldDoesNotExist, Max
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.forms.models import model_to_dict, modelform_factory
+from django.http.multipartparser import MultiPartParserError
+from django.middleware.csrf import CsrfViewMiddleware
+from django.http import Http404, HttpResponse, QueryDict
 from django.shortcuts import get_object_or_404
 from django.utils.cache import patch_vary_headers
+from django.utils.encoding import force_unicode
+from django.utils.functional import Promise
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.utils.translation import get_language
 from django.views import generic
 from django.views.decorators.csrf import csrf_exempt
 
+from towel import cbor, queryset_transform
+from towel.utils import (chunked, field_is_indexed, keyset_filter,
+    keyset_ordering, keyset_values, reverse_ordering, safe_queryset_and,
+    StreamingHttpResponse)
+
 
 class APIException(Exception):
     """
@@ -26,6 +60,11 @@ class APIException(Exception):
     or::
 
         raise ServerError('Not implemented, go away', status=501)
+
+    Details such as validation errors may be passed as ``errors``, they are
+    included in the response::
+
+        raise ClientError('Validation failed', errors=[...])
     """
     default_status = 400
 
@@ -44,8 +83,18 @@ class ServerError(APIException):
 #: The return value of ``Resource.objects``
 Objects = namedtuple('Objects', 'queryset page set single')
 
-#: The ``page`` object from ``Resource.objects``
-Page = namedtuple('Page', 'queryset offset limit total')
+#: The ``page`` object from ``Resource.objects``. ``total`` depends on the
+#: ``count_policy`` of the resource, ``has_next`` tells whether there are
+#: more objects after this page.
+Page = namedtuple('Page', 'queryset offset limit total has_next')
+
+#: The ``page`` object from ``Resource.objects`` if cursor pagination is
+#: active. ``previous`` and ``next`` are cursors or ``None``.
+CursorPage = namedtuple('CursorPage', 'queryset limit previous next')
+
+
+#: Primary key used to build URI templates in ``API.detail_uri``
+_URI_TEMPLATE_PK = 7319465028
 
 
 class API(object):
@@ -87,18 +136,39 @@ class API(object):
         )
     """
 
-    def __init__(self, name):
+    #: Maximum number of cached serializer plans with excluded fields (the
+    #: field sets are chosen by clients), the oldest plans are evicted first
+    max_serializer_plans = 100
+
+    def __init__(self, name, cache=None, cache_timeout=None):
+        """
+        ``cache`` is the name of a Django cache (f.e. ``'default'``) which
+        should be used to cache serialized instances, see
+        ``SerializationCache``. Caching is disabled by default.
+        """
         self.name = name
         self.resources = []
         self.serializers = {}
+        self._uri_templates = {}
+        self._serializer_plans = {}
+        self._excluding_plans = deque()
+        self._urls = None
+        self._root = {}
+        self.cache = None
+        if cache is not None:
+            self.cache = SerializationCache(self, cache, timeout=cache_timeout)
 
     @property
     def urls(self):
         """
         Inclusion point in your own URLconf
 
-        Pass the return value to ``include()``.
+        Pass the return value to ``include()``. The patterns are only built
+        once, ``register()`` discards them again.
         """
+        if self._urls is not None:
+            return self._urls
+
         urlpatterns = [
             url(r'^$', self, name='api_%s' % self.name),
             ]
@@ -109,11 +179,41 @@ class API(object):
                 include(resource['urlpatterns']),
                 ))
 
-        return patterns('', *urlpatterns)
+        self._urls = patterns('', *urlpatterns)
+        return self._urls
 
     def __call__(self, request):
         """
         Main API view, returns a list of all available resources
+
+        The encoded document is built once (per script prefix) and carries an
+        ``ETag``, clients sending a matching ``If-None-Match`` header get a
+        ``304 Not Modified`` response.
+        """
+        prefix = get_script_prefix()
+        if prefix not in self._root:
+            content = self.root_document()
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            self._root[prefix] = (content, hashlib.md5(content).hexdigest())
+        content, etag = self._root[prefix]
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            if etag in etags or '*' in etags:
+                response = HttpResponse(status=304)
+                response['ETag'] = quote_etag(etag)
+                return response
+
+        # TODO content negotiation :-(
+        response = HttpResponse(content, mimetype='application/json')
+        response['ETag'] = quote_etag(etag)
+        return response
+
+    def root_document(self):
+        """
+        Returns the JSON encoded list of all available resources
         """
         response = {
             '__unicode__': self.name,
@@ -131,8 +231,7 @@ class API(object):
             if resource['canonical']:
                 response[resource['model'].__name__.lower()] = r
 
-        # TODO content negotiation :-(
-        return HttpResponse(json.dumps(response), mimetype='application/json')
+        return json_backend()(response)
 
     def register(self, model, view_class=None, canonical=True,
             decorators=[csrf_exempt], prefix=None, view_init=None,
@@ -151,6 +250,8 @@ class API(object):
           list is applied in reverse, the order is therefore the same as with the
           ``@`` notation. It's recommended to always pass ``csrf_exempt`` here,
           otherwise API POSTing will have to include a valid CSRF middleware token.
+          Form encoded, multipart and plain text write requests of clients
+          with a session still need a token, see ``Resource.csrf_check_forms``.
         - ``prefix``: The prefix for this model, defaults to the model name in
           lowercase. You should include a caret and a trailing slash if you specify
           this yourself (``prefix=r'^library/'``).
@@ -187,18 +288,308 @@ class API(object):
                 url(r'^$', view, name=name('list')),
                 url(r'^(?P<pk>\d+)/$', view, name=name('detail')),
                 url(r'^(?P<pks>(?:\d+;)*\d+);?/$', view, name=name('set')),
+                url(r'^export\.(?P<export>ndjson|csv)$', view, name=name('export')),
                 ),
             })
 
         if serializer:
             self.serializers[model] = serializer
+        else:
+            self.serializer_plan(model)
+
+        if self.cache is not None:
+            self.cache.watch(model)
+
+        # Canonical URIs, URL patterns and the resource listing have changed
+        self._uri_templates.clear()
+        self._urls = None
+        self._root.clear()
+
+    def detail_uri(self, model, pk):
+        """
+        Returns the canonical URI of the ``model`` instance with primary key
+        ``pk`` inside this API, or ``None`` if there is no such URI. The result
+        is the same as that of ``api_reverse(model, 'detail', pk=pk,
+        fail_silently=True)``, but the URL resolver is only consulted once per
+        model; afterwards the URI is built from a cached template by string
+        formatting. Templates are cached per script prefix, since ``reverse()``
+        includes the prefix of the current thread.
+        """
+        if pk is None:
+            return None
+
+        key = (get_script_prefix(), model)
+        try:
+            template = self._uri_templates[key]
+        except KeyError:
+            template = self._uri_templates[key] = self._uri_template(model)
+
+        if template is None:
+            return None
+        elif template and isinstance(pk, (int, long)):
+            return template % pk
+        return api_reverse(model, 'detail', api_name=self.name, pk=pk,
+            fail_silently=True)
+
+    def _uri_template(self, model):
+        """
+        Reverses the detail URI of ``model`` with a marker primary key and
+        turns the result into a template for string formatting. Returns
+        ``None`` if there is no canonical URI and ``False`` if the marker
+        cannot be located unambiguously in the URI.
+        """
+        uri = api_reverse(model, 'detail', api_name=self.name,
+            pk=_URI_TEMPLATE_PK, fail_silently=True)
+
+        if uri is None:
+            return None
+
+        marker = str(_URI_TEMPLATE_PK)
+        if uri.count(marker) != 1:
+            return False
+        return uri.replace('%', '%%').replace(marker, '%s')
+
+    def serializer_plan(self, model, exclude=()):
+        """
+        Returns the ``SerializerPlan`` for ``model`` and ``exclude``, compiling
+        it if it does not exist yet. Plans without excluded fields are kept
+        forever, at most ``max_serializer_plans`` other plans are kept.
+        """
+        key = (model, frozenset(exclude))
+        try:
+            return self._serializer_plans[key]
+        except KeyError:
+            pass
+
+        plan = self._serializer_plans[key] = SerializerPlan(self, model, exclude)
+        if exclude:
+            self._excluding_plans.append(key)
+            while len(self._excluding_plans) > self.max_serializer_plans:
+                self._serializer_plans.pop(self._excluding_plans.popleft(), None)
+        return plan
 
     def serialize_instance(self, instance, **kwargs):
-        serializer = self.serializers.get(instance.__class__, serialize_model_instance)
-        return serializer(instance, api=self, **kwargs)
+        """
+        Serializes ``instance`` using the serializer registered for its model
+        or the compiled ``SerializerPlan`` otherwise.
+        """
+        model = instance_model(instance)
+        serializer = self.serializers.get(model)
+        if serializer is not None:
+            if kwargs.get('pretty', True):
+                # Only passed if disabled, serializers written before the
+                # argument existed might not accept it
+                kwargs.pop('pretty', None)
+            return serializer(instance, api=self, **kwargs)
+
+        exclude = kwargs.pop('exclude', ())
+        return self.serializer_plan(model, exclude)(instance, **kwargs)
+
+    def serialize_instances(self, instances, **kwargs):
+        """
+        Serializes a list of instances, using the ``SerializationCache`` if
+        caching is enabled for this API.
+        """
+        if self.cache is not None:
+            return self.cache.serialize_instances(instances, **kwargs)
+        return [self.serialize_instance(instance, **kwargs) for instance in instances]
+
+
+class SerializationCache(object):
+    """
+    Caches the output of ``API.serialize_instance`` in a Django cache. Pass
+    the name of the cache when creating the API to enable it::
+
+        api_v1 = API('v1', cache='default', cache_timeout=3600)
+
+    There is one entry per API, model, primary key and ``inline_depth``;
+    the serializations for different ``exclude`` values are stored
+    together inside the entry. The entries and generation counters needed
+    for a page of objects are fetched with one ``get_many`` call.
+
+    Saving or deleting an instance of a registered model deletes its
+    entries. Changes to related models (which might be inlined or used in
+    ``__unicode__``) and to many to many relations increment the generation
+    counter of the registered model, which invalidates all of its entries.
+    Instances are only cached up to an ``inline_depth`` of ``max_depth``.
+    Serializations including ``__pretty__`` values are stored per language.
+    """
+
+    #: Maximum number of serializations (different ``exclude`` values and
+    #: languages) stored in one entry, further variants replace the entry
+    max_variants = 8
+
+    def __init__(self, api, cache, timeout=None, max_depth=1):
+        self.api = api
+        self.cache = get_cache(cache)
+        self.timeout = timeout
+        self.max_depth = max_depth
+
+        #: Watched models whose serializations depend on the key model
+        self.dependents = {}
+
+    def _prefix(self, model):
+        opts = model._meta
+        return 'towel-api:%s:%s.%s' % (self.api.name, opts.app_label, opts.module_name)
+
+    def entry_key(self, model, pk, inline_depth):
+        return '%s:%s:%s' % (self._prefix(model), pk, inline_depth)
+
+    def generation_key(self, model):
+        return '%s:generation' % self._prefix(model)
+
+    def serialize_instances(self, instances, inline_depth=0, exclude=(),
+            pretty=True):
+        """
+        Returns the serialized representations of ``instances``, from the
+        cache where possible. Misses are serialized and stored.
+        """
+        kwargs = {'inline_depth': inline_depth, 'exclude': exclude,
+            'pretty': pretty}
+
+        if inline_depth > self.max_depth or not instances:
+            return [self.api.serialize_instance(instance, **kwargs)
+                for instance in instances]
+
+        variant = (tuple(sorted(exclude)), get_language() if pretty else None)
+        models = [instance_model(instance) for instance in instances]
+        keys = [self.entry_key(model, instance.pk, inline_depth)
+            for model, instance in zip(models, instances)]
+        generation_keys = dict((model, self.generation_key(model))
+            for model in models)
+
+        cached = self.cache.get_many(keys + generation_keys.values())
+
+        generations = {}
+        for model, key in generation_keys.items():
+            generation = cached.get(key)
+            if generation is None:
+                # Time based, so that entries written before the counter
+                # was evicted are not considered valid again
+                self.cache.add(key, int(time.time() * 1000))
+                generation = self.cache.get(key)
+            generations[model] = generation
+
+        results, updates = [], {}
+        for model, instance, key in zip(models, instances, keys):
+            generation = generations[model]
+            entry = updates.get(key) or cached.get(key)
+            if entry is None or entry[0] != generation:
+                entry = (generation, {})
+
+            if variant not in entry[1]:
+                if len(entry[1]) >= self.max_variants:
+                    entry = (generation, {})
+                entry[1][variant] = self.api.serialize_instance(instance, **kwargs)
+                updates[key] = entry
+            results.append(entry[1][variant])
+
+        if updates:
+            self.cache.set_many(updates, self.timeout)
+        return results
+
+    def invalidate_instance(self, model, pk):
+        """
+        Removes all cached serializations of one instance
+        """
+        self.cache.delete_many([self.entry_key(model, pk, depth)
+            for depth in range(self.max_depth + 1)])
+
+    def instances_changed(self, model, pks):
+        """
+        Invalidates the cached serializations affected by changes to the
+        instances of ``model`` with the primary keys ``pks`` which did not
+        send any signals, f.e. because they were made using ``update()``.
+        """
+        self.cache.delete_many([self.entry_key(model, pk, depth)
+            for pk in pks for depth in range(self.max_depth + 1)])
+
+        for dependent in self.dependents.get(model, ()):
+            self.invalidate_model(dependent)
+
+    def invalidate_model(self, model):
+        """
+        Invalidates all cached serializations of instances of ``model``
+        """
+        try:
+            self.cache.incr(self.generation_key(model))
+        except ValueError:
+            # No counter, no valid entries
+            pass
+
+    def watch(self, model):
+        """
+        Connects the signal handlers invalidating the cached serializations
+        of ``model``.
+        """
+        def instance_changed(sender, instance, **kwargs):
+            self.invalidate_instance(model, instance.pk)
+
+        def related_changed(sender, **kwargs):
+            self.invalidate_model(model)
+
+        uid = 'towel-api-cache:%s' % self._prefix(model)
+        post_save.connect(instance_changed, sender=model, weak=False,
+            dispatch_uid=uid)
+        post_delete.connect(instance_changed, sender=model, weak=False,
+            dispatch_uid=uid)
+
+        # Inlined objects at max_depth still contain their __unicode__ value
+        related, through = related_models(model, self.max_depth + 1)
+
+        for related_model in related:
+            self.dependents.setdefault(related_model, set()).add(model)
+            related_uid = '%s:%s' % (uid, self._prefix(related_model))
+            post_save.connect(related_changed, sender=related_model, weak=False,
+                dispatch_uid=related_uid)
+            post_delete.connect(related_changed, sender=related_model, weak=False,
+                dispatch_uid=related_uid)
+
+        for through_model in through:
+            m2m_changed.connect(related_changed, sender=through_model, weak=False,
+                dispatch_uid='%s:%s' % (uid, self._prefix(through_model)))
+
+
+def instance_model(instance):
+    """
+    Returns the model of ``instance``, skipping the classes Django creates
+    for instances with deferred fields.
+    """
+    model = instance.__class__
+    if getattr(model, '_deferred', False):
+        model = model._meta.proxy_for_model
+    return model
+
+
+def related_models(model, depth):
+    """
+    Returns two sets, the models reachable from ``model`` through at most
+    ``depth`` foreign key or many to many relations and the through models
+    of the many to many relations on the way.
+    """
+    related, through = set(), set()
+
+    def walk(model, depth):
+        if depth <= 0:
+            return
+
+        opts = model._meta
+        for f in opts.fields:
+            if f.rel:
+                related.add(f.rel.to)
+                walk(f.rel.to, depth - 1)
+
+        for f in opts.many_to_many:
+            related.add(f.rel.to)
+            through.add(f.rel.through)
+            walk(f.rel.to, depth - 1)
+
+    walk(model, depth)
+    return related, through
 
 
-def serialize_model_instance(instance, api, inline_depth=0, exclude=(), **kwargs):
+def serialize_model_instance(instance, api, inline_depth=0, exclude=(),
+        pretty=True, **kwargs):
     """
     Serializes a single model instance.
 
@@ -219,67 +610,205 @@ def serialize_model_instance(instance, api, inline_depth=0, exclude=(), **kwargs
       because of that we either show the full objects or nothing at all.
     - Some fields (currently only fields with choices) have a machine readable
       and a prettified value. The prettified values are delivered inside the
-      ``__pretty__`` dictionary for your convenience.
+      ``__pretty__`` dictionary for your convenience, unless ``pretty`` is
+      ``False``.
     """
 
     # It's not exactly a fatal error, but it helps during development. This
     # statement will disappear in the future.
     assert not kwargs, 'Unknown keyword arguments to serialize_model_instance'
 
-    uri = api_reverse(instance, 'detail', api_name=api.name,
-        pk=instance.pk, fail_silently=True)
+    return api.serializer_plan(instance_model(instance), exclude)(instance,
+        inline_depth=inline_depth, pretty=pretty)
 
-    if uri is None:
-        return None
 
-    data = {
-        '__uri__': uri,
-        '__unicode__': unicode(instance),
-        '__pretty__': {},
-        }
-    opts = instance._meta
+class SerializerPlan(object):
+    """
+    Compiled serializer for one model and ``exclude`` combination, created
+    through ``API.serializer_plan``. The fields to process, their accessors,
+    choice maps and related models are determined once when the plan is
+    created; calling the plan with an instance produces exactly the same
+    data as ``serialize_model_instance``.
+
+    The prettified choice values are computed once per language and kept
+    for the life of the plan (that is, the process).
+    """
 
-    for f in opts.fields:
-        if f.name in exclude:
-            continue
+    def __init__(self, api, model, exclude=()):
+        self.api = api
+        self.model = model
+
+        opts = model._meta
+
+        #: ``(name, value_from_object, related_model, has_choices)`` tuples
+        self.fields = []
+        #: Lazy choices of fields, prettified by ``pretty_choices()``
+        self.choices = {}
+        for f in opts.fields:
+            if f.name in exclude:
+                continue
+
+            if f.rel:
+                self.fields.append((f.name, f.value_from_object, f.rel.to, False))
+            else:
+                self.fields.append((f.name, f.value_from_object, None,
+                    bool(f.flatchoices)))
+                if f.flatchoices:
+                    self.choices[f.name] = f.flatchoices
+
+        #: Names of many to many fields, only processed if ``inline_depth > 0``
+        self.many_to_many = [f.name for f in opts.many_to_many
+            if f.name not in exclude]
+
+        self._pretty_choices = {}
+
+    def pretty_choices(self):
+        """
+        Returns a dictionary mapping field names to dictionaries mapping
+        values to their prettified representation in the active language.
+        """
+        language = get_language()
+        try:
+            return self._pretty_choices[language]
+        except KeyError:
+            choices = self._pretty_choices[language] = dict(
+                (name, dict((value, unicode(label)) for value, label in flatchoices))
+                for name, flatchoices in self.choices.items())
+            return choices
+
+    def __call__(self, instance, inline_depth=0, pretty=True):
+        api = self.api
+        uri = api.detail_uri(self.model, instance.pk)
+
+        if uri is None:
+            return None
+
+        data = {
+            '__uri__': uri,
+            '__unicode__': unicode(instance),
+            }
+
+        if pretty:
+            pretty_values = data['__pretty__'] = {}
+            choices = self.pretty_choices()
+
+        for name, value_from_object, related_model, has_choices in self.fields:
+            if related_model is not None:
+                if inline_depth > 0:
+                    related = getattr(instance, name)
+                    if related:
+                        data[name] = api.serialize_instance(related,
+                            inline_depth=inline_depth-1, pretty=pretty)
+                    else:
+                        data[name] = None
 
-        if f.rel:
-            if inline_depth > 0:
-                if getattr(instance, f.name):
-                    data[f.name] = api.serialize_instance(
-                        getattr(instance, f.name),
-                        inline_depth=inline_depth-1,
-                        )
                 else:
-                    data[f.name] = None
+                    related_uri = api.detail_uri(related_model,
+                        value_from_object(instance))
+                    if related_uri is None:
+                        continue
+                    data[name] = related_uri
 
             else:
-                try:
-                    data[f.name] = api_reverse(f.rel.to, 'detail', api_name=api.name,
-                        pk=f.value_from_object(instance))
-                except NoReverseMatch:
-                    continue
+                value = data[name] = value_from_object(instance)
 
-        else:
-            data[f.name] = f.value_from_object(instance)
+                if has_choices and pretty:
+                    pretty_values[name] = choices[name].get(value, u'-')
 
-            if f.flatchoices:
-                data['__pretty__'][f.name] = unicode(
-                    dict(f.flatchoices).get(data[f.name], '-'))
+        if inline_depth > 0:
+            prefetched = getattr(instance, '_api_prefetched', {})
+
+            for name in self.many_to_many:
+                if name in prefetched:
+                    objs = prefetched[name]
+                else:
+                    objs = getattr(instance, name).all()
+
+                related = [
+                    api.serialize_instance(obj, inline_depth=inline_depth-1,
+                        pretty=pretty)
+                    for obj in objs]
+
+                if any(related):
+                    data[name] = related
+
+        return data
+
+
+def select_related_paths(model, depth, exclude=()):
+    """
+    Returns the ``select_related`` arguments needed to serialize instances
+    of ``model`` with ``inline_depth=depth`` without additional queries for
+    foreign keys. ``exclude`` is only applied to the fields of ``model``
+    itself, as is the case when serializing.
+    """
+    paths = []
+    if depth <= 0:
+        return paths
+
+    for f in model._meta.fields:
+        if f.rel and f.name not in exclude:
+            nested = select_related_paths(f.rel.to, depth - 1)
+            paths.extend(['%s__%s' % (f.name, path) for path in nested] or [f.name])
+
+    return paths
 
-    if inline_depth > 0:
-        for f in opts.many_to_many:
-            if f.name in exclude:
-                continue
 
-            related = [
-                api.serialize_instance(obj, inline_depth=inline_depth-1)
-                for obj in getattr(instance, f.name).all()]
+def prefetch_many_to_many(instances, depth, exclude=()):
+    """
+    Fetches the many to many relations needed to serialize ``instances`` (a
+    list of instances of the same model) with ``inline_depth=depth`` using
+    one query per relation and stores them in ``instance._api_prefetched``
+    where ``SerializerPlan`` picks them up. Related instances reached through
+    ``select_related`` and the fetched instances themselves are processed
+    recursively.
+
+    Meant to be used with ``towel.queryset_transform``::
+
+        queryset.transform(lambda instances: prefetch_many_to_many(
+            instances, depth))
+    """
+    if depth <= 0 or not instances:
+        return
+
+    opts = instance_model(instances[0])._meta
+
+    for f in opts.fields:
+        if f.rel and f.name not in exclude:
+            # Already loaded through select_related, see select_related_paths
+            related = [getattr(instance, f.name) for instance in instances]
+            prefetch_many_to_many([obj for obj in related if obj is not None],
+                depth - 1)
+
+    using = instances[0]._state.db
+    qn = connections[using].ops.quote_name
 
-            if any(related):
-                data[f.name] = related
+    for f in opts.many_to_many:
+        if f.name in exclude:
+            continue
+
+        queryset = f.rel.to._default_manager.using(using).filter(**{
+            '%s__in' % f.related_query_name(): [instance.pk for instance in instances],
+            }).extra(select={
+                '_api_prefetch_source': '%s.%s' % (
+                    qn(f.m2m_db_table()), qn(f.m2m_column_name())),
+            })
 
-    return data
+        paths = select_related_paths(f.rel.to, depth - 1)
+        if paths:
+            queryset = queryset.select_related(*paths)
+
+        objs = list(queryset)
+        related = {}
+        for obj in objs:
+            related.setdefault(obj._api_prefetch_source, []).append(obj)
+
+        for instance in instances:
+            if not hasattr(instance, '_api_prefetched'):
+                instance._api_prefetched = {}
+            instance._api_prefetched[f.name] = related.get(instance.pk, [])
+
+        prefetch_many_to_many(objs, depth - 1)
 
 
 def api_reverse(model, ident, api_name='api', fail_silently=False, **kwargs):
@@ -327,10 +856,131 @@ class Resource(generic.View):
     limit_per_page = 20
     max_limit_per_page = 1000
 
+    #: Maximum number of primary keys accepted in set URIs (``resource/1;3;5/``)
+    max_set_size = 100
+
+    #: Number of objects fetched per query by exports, see ``export()``
+    export_chunk_size = 1000
+
+    #: Pagination mode for list views, either ``'offset'`` or ``'cursor'``.
+    #: Cursor pagination uses opaque ``after`` and ``before`` tokens instead
+    #: of offsets; the cost of fetching a page does not depend on the
+    #: position of the page inside the result set. The ordering columns
+    #: should be indexed (see ``towel.utils.keyset_ordering``).
+    pagination = 'offset'
+
+    #: Determines the ``total`` value in the metadata of offset paginated lists:
+    #:
+    #: - ``'exact'``: ``queryset.count()``
+    #: - ``'capped'``: Counts up to ``count_cap`` objects, bigger totals are
+    #:   reported as ``'<count_cap>+'``
+    #: - ``'estimate'``: The estimate of the query planner (PostgreSQL only,
+    #:   behaves as ``'capped'`` on other databases)
+    #: - ``None``: No total is reported at all
+    #:
+    #: The existence of a next page is determined by fetching one object more
+    #: than requested for all policies except ``'exact'``.
+    count_policy = 'exact'
+    count_cap = 1000
+
+    #: Stream lists and sets to the client object by object instead of building
+    #: the whole response in memory first. The memory usage does not depend on
+    #: ``limit`` anymore, but errors cannot be reported once streaming has
+    #: started.
+    streaming = False
+
+    #: Validator used to answer conditional GET requests (``If-None-Match`` and
+    #: ``If-Modified-Since``) with ``304 Not Modified`` before serializing
+    #: anything. A callable receiving the resource and the return value of
+    #: ``objects()`` and returning a ``(etag, last_modified)`` tuple, either
+    #: of which may be ``None``. See ``LastModifiedValidator`` and
+    #: ``VersionValidator``. Usually passed in ``view_init``::
+    #:
+    #:     api.register(Product, view_init={
+    #:         'validator': LastModifiedValidator('updated_at'),
+    #:         })
+    validator = None
+
+    #: Rate limiter applied before processing any request, ``None`` disables
+    #: rate limiting. See ``RateLimit``::
+    #:
+    #:     api.register(Product, view_init={
+    #:         'rate_limit': RateLimit(rate=600, per=60, concurrency=4),
+    #:         })
+    rate_limit = None
+
+    #: Mimetypes of the formats this resource may respond with, defaults to
+    #: all formats registered using ``register_format``. The format is
+    #: selected using the ``Accept`` header of the request.
+    formats = None
+
+    #: Mimetypes of the request bodies this resource accepts, defaults to all
+    #: parsers registered using ``register_parser``
+    parsers = None
+
+    #: Maximum size of request bodies in bytes, larger requests are refused
+    #: with ``413 Request Entity Too Large`` before the body is read. ``None``
+    #: disables the check.
+    max_body_size = 2621440
+
+    #: Require a valid CSRF token for form encoded, multipart and plain text
+    #: write requests of clients with a session cookie even though resources
+    #: are registered with ``csrf_exempt``, see ``check_csrf``
+    csrf_check_forms = True
+
+    #: Metrics sink receiving per-request timings, query counts, serialized
+    #: rows and response sizes, ``None`` disables instrumentation. See
+    #: ``LoggingMetricsSink``, ``StatsdMetricsSink`` and ``RingBufferMetricsSink``
+    metrics = None
+
+    #: Echo the collected metrics in the ``X-API-Metrics`` response header
+    #: (only if ``metrics`` is set). Do not enable this in production, the
+    #: header exposes internals.
+    metrics_header = False
+
     #: Almost the same as ``django.views.generic.View.http_method_names`` but not quite,
     #: we allow ``patch``, but do not allow ``options`` and ``trace``.
     http_method_names = ['get', 'post', 'put', 'delete', 'head', 'patch']
 
+    #: Fields which are not loaded from the database if the client does not
+    #: want them serialized, f.e. large text columns. Other fields are always
+    #: loaded; ``__unicode__`` and methods using deferred fields cause one
+    #: query per object.
+    deferrable_fields = ()
+
+    #: Lookups clients may use to filter lists, a dictionary mapping field
+    #: names to the allowed lookups (``exact``, ``in``, ``range`` and
+    #: ``isnull``)::
+    #:
+    #:     filters = {
+    #:         'category': ('exact', 'in'),
+    #:         'created': ('range',),
+    #:         'parent': ('isnull',),
+    #:         }
+    #:
+    #: The lookups are used as GET parameters, ``in`` and ``range`` values are
+    #: comma separated: ``?category__in=1,2&created__range=2012-01-01,2012-02-01``
+    filters = {}
+
+    #: Fields clients may order lists by using the ``order_by`` GET parameter
+    #: (``?order_by=-created,name``)
+    orderings = ()
+
+    #: Handling of filters and orderings on fields without database index:
+    #: ``'refuse'`` (respond with ``400 Bad Request``), ``'warn'`` (emit a
+    #: ``RuntimeWarning``) or ``None`` (allow)
+    unindexed = 'refuse'
+
+    #: ``towel.forms.SearchForm`` subclass applied to list views. Searches
+    #: are not persisted. Form fields naming model fields are subject to
+    #: ``unindexed`` like ``filters``; the full text ``query`` searches the
+    #: ``search_fields`` of the manager, which cannot use indexes.
+    search_form = None
+
+    #: Form class used to validate objects in bulk writes, defaults to a
+    #: ``ModelForm`` for ``model``
+    form_class = None
+
     def dispatch(self, request, *args, **kwargs):
         """
         This method is almost the same as Django's own ``generic.View.dispatch()``,
@@ -341,17 +991,21 @@ class Resource(generic.View):
           variables on ``self`` which may modify all aspects and all variables (f.e.
           deserialize a JSON request and serialize it again to look like a standard
           POST request) and only then determines whether the request should be handled
-          by this view at all.
+          by this view at all. ``APIException`` raised there is turned into an
+          error response as well.
         - The return value of the ``get()``, ``post()`` etc. methods is passed to
           ``self.serialize_response()`` and only then returned to the client. The
           processing methods should return data (a ``dict`` instance most of the time)
           which is then serialized into the requested format or some different supported
           format.
+        - Headers added to ``self.response_headers`` by the processing methods are
+          set on the response, whatever its format.
         """
         self.request = request
         self.args = args
         self.kwargs = kwargs
-        self.unserialize_request()
+        self.response_headers = {}
+        self.request_metrics = RequestMetrics() if self.metrics else None
 
         # Try to dispatch to the right method; if a method doesn't exist,
         # defer to the error handler. Also defer to the error handler if the
@@ -361,14 +1015,126 @@ class Resource(generic.View):
         else:
             handler = self.http_method_not_allowed
 
+        response, concurrency_key = None, None
         try:
-            return self.serialize_response(handler(
-                self.request, *self.args, **self.kwargs))
+            if self.rate_limit:
+                concurrency_key = self.check_rate_limit()
+            self.unserialize_request()
+            with self.measure('handle'):
+                data = handler(self.request, *self.args, **self.kwargs)
+            with self.measure('encode'):
+                response = self.serialize_response(data)
         except Http404 as e:
-            return self.serialize_response({'error': e[0]}, status=404)
+            response = self.serialize_response({'error': e[0]}, status=404)
         except APIException as e:
-            return self.serialize_response({'error': e[0]},
+            data = {'error': e[0]}
+            if 'errors' in e.kwargs:
+                data['errors'] = e.kwargs['errors']
+            response = self.serialize_response(data,
                 status=e.kwargs.get('status', e.default_status))
+        finally:
+            if concurrency_key:
+                release = lambda: self.rate_limit.release(concurrency_key)
+                if response is not None and is_streaming(response):
+                    # The body is produced while it is sent to the client
+                    call_when_streamed(response, release)
+                else:
+                    release()
+            if self.request_metrics is not None:
+                self.request_metrics.finish()
+
+        if self.request_metrics is not None:
+            self.emit_metrics(response)
+
+        for key, value in self.response_headers.items():
+            response[key] = value
+        return response
+
+    @contextmanager
+    def measure(self, phase):
+        """
+        Context manager adding the time spent in the block to ``phase`` of
+        the request metrics. Does nothing if ``metrics`` is not set::
+
+            with self.measure('aggregate'):
+                totals = queryset.aggregate(Sum('price'))
+        """
+        if self.request_metrics is None:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.request_metrics.add_time(phase, time.time() - start)
+
+    def emit_metrics(self, response):
+        """
+        Passes the finished request metrics to the ``metrics`` sink and
+        adds the ``X-API-Metrics`` header if ``metrics_header`` is set.
+        Streamed responses have not been encoded yet at this point; their
+        ``bytes`` are ``None`` and their serialization time is not recorded.
+        """
+        metrics = self.request_metrics
+        if not is_streaming(response):
+            metrics.bytes = len(response.content)
+
+        opts = self.model._meta
+        data = dict(metrics.as_dict(),
+            resource='%s.%s' % (opts.app_label, opts.module_name),
+            method=self.request.method,
+            status=response.status_code)
+        self.metrics(self, data)
+
+        if self.metrics_header:
+            self.response_headers['X-API-Metrics'] = metrics.header()
+
+    def check_rate_limit(self):
+        """
+        Consumes ``request_cost()`` tokens from the client's bucket and
+        acquires a slot of the concurrency budget of ``rate_limit``. Raises
+        a ``ClientError`` with status ``429 Too Many Requests`` and sets the
+        ``Retry-After`` header if the client has to back off.
+
+        Returns the key which has to be passed to ``rate_limit.release()``
+        once the request has been processed, or ``None``.
+        """
+        opts = self.model._meta
+        key = '%s.%s:%s' % (opts.app_label, opts.module_name,
+            self.rate_limit.client_key(self.request))
+
+        retry_after = self.rate_limit.consume(key, self.request_cost())
+        if retry_after:
+            self.response_headers['Retry-After'] = str(retry_after)
+            raise ClientError('Rate limit exceeded', status=429)
+
+        if not self.rate_limit.acquire(key):
+            self.response_headers['Retry-After'] = '1'
+            raise ClientError('Too many concurrent requests', status=429)
+        return key if self.rate_limit.concurrency else None
+
+    def request_cost(self):
+        """
+        Returns the number of tokens the current request costs. Lists cost one
+        token per ``limit_per_page`` objects requested, sets one token per
+        ``limit_per_page`` primary keys. The cost is multiplied by the inline
+        depth plus one, inlining related objects is expensive.
+        """
+        if self.request.method != 'GET':
+            return 1
+
+        if 'export' in self.kwargs:
+            size = self.max_limit_per_page
+        elif 'pk' in self.kwargs:
+            size = 1
+        elif 'pks' in self.kwargs:
+            size = len(self.kwargs['pks'].split(';'))
+        else:
+            size = self.get_limit()
+
+        return max(1, -(-size // self.limit_per_page)) * (
+            self.get_inline_depth() + 1)
 
     def unserialize_request(self):
         """
@@ -377,8 +1143,77 @@ class Resource(generic.View):
 
         The "real" processing methods should not have to distinguish between
         varying request types anymore.
+
+        The default implementation refuses request bodies larger than
+        ``max_body_size`` using the ``Content-Length`` header, before any
+        part of the body is read. The body itself is parsed lazily, see
+        ``data``. Write requests are checked using ``check_csrf()`` if
+        ``csrf_check_forms`` is set.
+        """
+        try:
+            length = int(self.request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise ClientError('Invalid Content-Length header')
+
+        if self.max_body_size is not None and length > self.max_body_size:
+            raise ClientError('Request body too large, the maximum is %s bytes' % (
+                self.max_body_size), status=413)
+
+        if self.csrf_check_forms and self.request.method not in (
+                'GET', 'HEAD', 'OPTIONS', 'TRACE'):
+            self.check_csrf()
+
+    def check_csrf(self):
+        """
+        Resources are registered with ``csrf_exempt`` by default. Form encoded,
+        multipart and plain text bodies can be sent by any website using the
+        browser (and the session) of the user though, therefore requests
+        with such bodies are refused unless they contain a valid CSRF token
+        if a session cookie is present. Other content types such as JSON
+        cannot be sent cross-site without the consent of the server (CORS).
+
+        Set ``csrf_check_forms = False`` for resources used by clients which
+        post forms with a session but without CSRF token.
+        """
+        content_type = self.request.META.get('CONTENT_TYPE', '')
+        content_type = (content_type.split(';')[0].strip()
+            or 'application/x-www-form-urlencoded')
+
+        if content_type not in ('application/x-www-form-urlencoded',
+                'multipart/form-data', 'text/plain'):
+            return
+        if settings.SESSION_COOKIE_NAME not in self.request.COOKIES:
+            return
+
+        if CsrfViewMiddleware().process_view(self.request, None, (), {}):
+            raise ClientError('CSRF verification failed', status=403)
+
+    @property
+    def data(self):
+        """
+        The request body decoded into Python data structures by the parser
+        registered for its content type (see ``register_parser``), f.e. a
+        ``dict`` or ``list`` for JSON and a ``QueryDict`` for form encoded
+        bodies. Bodies without content type are treated as form encoded. The
+        body is only parsed when this attribute is accessed the first time.
         """
-        pass
+        if not hasattr(self, '_data'):
+            content_type = self.request.META.get('CONTENT_TYPE', '')
+            content_type = (content_type.split(';')[0].strip()
+                or 'application/x-www-form-urlencoded')
+
+            parser = PARSERS.get(content_type)
+            if parser is None or (
+                    self.parsers is not None and content_type not in self.parsers):
+                raise ClientError('Unsupported content type %r' % content_type,
+                    status=415)
+
+            try:
+                self._data = parser(self.request)
+            except ValueError:
+                raise ClientError('Invalid %s in request body' % content_type)
+
+        return self._data
 
     def serialize_response(self, response, status=200):
         """
@@ -388,28 +1223,21 @@ class Resource(generic.View):
         if isinstance(response, HttpResponse):
             return response
 
-        formats = [
-            ('application/json', {
-                'handler': lambda response, output_format, config: (
-                    HttpResponse(json.dumps(response, cls=DjangoJSONEncoder),
-                        mimetype='application/json', status=status)),
-                }),
-            #('text/html', {
-                #'handler': self.serialize_response_html,
-                #}),
-            ]
+        formats = [(format, handler) for format, handler in FORMATS
+            if self.formats is None or format in self.formats]
 
         # Thanks!
         # https://github.com/toastdriven/django-tastypie/blob/master/tastypie/utils/mime.py
         try:
             output_format = mimeparse.best_match(
-                reversed([format for format, config in formats]),
+                reversed([format for format, handler in formats]),
                 self.request.META.get('HTTP_ACCEPT'))
         except IndexError:
-            output_format = 'application/json'
+            output_format = None
 
-        config = dict(formats)[output_format]
-        response = config['handler'](response, output_format, config)
+        # The first format (JSON, unless restricted) is the default
+        handler = dict(formats).get(output_format) or formats[0][1]
+        response = handler(response, status=status)
         patch_vary_headers(response, ('Accept',))
         return response
 
@@ -427,118 +1255,1455 @@ class Resource(generic.View):
         """
         Applies filters to the queryset. This method will only be called for
         list views, not when the user requested sets or single instances.
+
+        The default implementation applies the ``search_form`` (if any), the
+        lookups declared in ``filters`` and the ordering requested with the
+        ``order_by`` GET parameter if it is listed in ``orderings``. Filters
+        and orderings on fields without database index are handled according
+        to ``unindexed``.
         """
+        if self.search_form:
+            form = self.search_form(self.request.GET, request=self.request,
+                persistent=False)
+
+            for name in form.fields:
+                if name in form.always_exclude or not self.request.GET.get(name):
+                    continue
+                try:
+                    self.model._meta.get_field(name)
+                except FieldDoesNotExist: # Handled by the form itself
+                    continue
+                self.check_indexed(name, 'filter')
+
+            queryset = safe_queryset_and(queryset, form.queryset(self.model))
+
+        for key, values in self.request.GET.lists():
+            field, _, lookup = key.partition('__')
+            if field not in self.filters:
+                continue
+
+            lookup = lookup or 'exact'
+            if lookup not in self.filters[field]:
+                raise ClientError('Lookup %r is not allowed' % key)
+
+            self.check_indexed(field, 'filter')
+
+            value = values[-1]
+            if lookup in ('in', 'range'):
+                value = value.split(',')
+                if lookup == 'range' and len(value) != 2:
+                    raise ClientError('Range lookups need two comma separated values')
+            elif lookup == 'isnull':
+                value = value.lower() in ('1', 'true', 'yes', 'on')
+
+            try:
+                queryset = queryset.filter(**{'%s__%s' % (field, lookup): value})
+            except (TypeError, ValueError, ValidationError):
+                raise ClientError('Invalid value for %r' % key)
+
+        order_by = [field.strip() for field
+            in self.request.GET.get('order_by', '').split(',') if field.strip()]
+        if order_by:
+            for field in order_by:
+                if field.lstrip('-') not in self.orderings:
+                    raise ClientError('Ordering by %r is not allowed' % field)
+
+            # Only the leading column decides whether an index can be used
+            self.check_indexed(order_by[0].lstrip('-'), 'order')
+            queryset = queryset.order_by(*order_by)
+
+            if self.pagination == 'cursor':
+                try:
+                    keyset_ordering(queryset)
+                except ValueError as e:
+                    raise ClientError(e[0])
+
         return queryset
 
+    def check_indexed(self, field, action):
+        """
+        Raises a ``ClientError`` or emits a warning (depending on ``unindexed``)
+        if there is no database index on ``field``.
+        """
+        if self.unindexed is None or field_is_indexed(self.model, field):
+            return
+
+        message = 'Cannot %s by %r, there is no database index on it' % (
+            action, field)
+        if self.unindexed == 'refuse':
+            raise ClientError(message)
+        warnings.warn(message, RuntimeWarning)
+
+    def get_limit(self):
+        """
+        Returns the page size requested using the ``limit`` GET parameter,
+        but never more than ``max_limit_per_page``.
+        """
+        try:
+            limit = int(self.request.GET.get('limit'))
+        except (TypeError, ValueError):
+            limit = self.limit_per_page
+
+        # Do not allow more than max_limit_per_page entries in one request, ever
+        return max(min(limit, self.max_limit_per_page), 0)
+
+    def get_inline_depth(self):
+        """
+        Returns the ``inline_depth`` used for serializing objects. Related
+        objects are inlined if the ``full`` GET parameter is set.
+        """
+        return 1 if self.request.GET.get('full') else 0
+
+    def get_pretty(self):
+        """
+        Returns whether the ``__pretty__`` values should be included. Clients
+        which do not need them may skip them using ``pretty=0``.
+        """
+        return self.request.GET.get('pretty', '1').lower() not in (
+            '0', 'false', 'no', 'off')
+
+    def get_exclude(self):
+        """
+        Returns the names of the fields which should not be serialized. Clients
+        select the fields using either the ``fields`` GET parameter (fields to
+        include) or the ``exclude`` GET parameter (fields to leave out), both
+        containing comma separated field names.
+        """
+        opts = self.model._meta
+        available = [f.name for f in opts.fields + opts.many_to_many]
+
+        fields, exclude = [
+            [name.strip() for name in self.request.GET.get(key, '').split(',')
+                if name.strip()]
+            for key in ('fields', 'exclude')]
+
+        unknown = set(fields + exclude) - set(available)
+        if unknown:
+            raise ClientError('Unknown fields: %s' % u', '.join(sorted(unknown)))
+
+        if fields:
+            exclude.extend(name for name in available if name not in fields)
+        return tuple(sorted(set(exclude)))
+
+    def optimize_queryset(self, queryset, inline_depth, exclude=(), prefetch=True):
+        """
+        Prepares ``queryset`` for serialization with ``inline_depth`` and
+        ``exclude``: Excluded fields listed in ``deferrable_fields`` are
+        deferred (except for fields needed for pagination or by the
+        ``validator``), foreign keys are loaded using ``select_related`` and
+        many to many relations are fetched in batches using a
+        ``towel.queryset_transform`` transform. The number of queries needed
+        to serialize a page does not depend on the number of objects on it.
+
+        The transform needs all instances at once. Pass ``prefetch=False``
+        if the instances are fetched piece by piece and call
+        ``prefetch_many_to_many`` for every piece yourself.
+        """
+        if exclude and self.deferrable_fields:
+            keep = set(getattr(self.validator, 'fields', ()))
+            if self.pagination == 'cursor':
+                keep.update(field.lstrip('-') for field in keyset_ordering(queryset))
+
+            deferred = [f.name for f in queryset.model._meta.fields
+                if f.name in exclude and f.name in self.deferrable_fields
+                and f.name not in keep and not f.primary_key]
+            if deferred:
+                queryset = queryset.defer(*deferred)
+
+        if inline_depth <= 0:
+            return queryset
+
+        paths = select_related_paths(queryset.model, inline_depth, exclude)
+        if paths:
+            queryset = queryset.select_related(*paths)
+
+        if not prefetch:
+            return queryset
+
+        if not hasattr(queryset, 'transform'):
+            queryset = queryset._clone(klass=queryset_transform.TransformQuerySet)
+
+        return queryset.transform(
+            lambda instances: prefetch_many_to_many(instances, inline_depth, exclude))
+
     def objects(self):
         """
         Returns a namedtuple with the following attributes:
 
         - ``queryset``: Available items, filtered and all (if applicable).
         - ``page``: Current page
-        - ``set``: List of objects or ``None`` if not applicable. Will be used for
-          requests such as ``/api/product/1;3/``.
+        - ``set``: List of objects in the requested order or ``None`` if not
+          applicable. Will be used for requests such as ``/api/product/1;3/``.
         - ``single``: Single instances if applicable, used for URIs such as
           ``/api/product/1/``.
 
         Raises a 404 if the referenced items do not exist.
         """
         queryset, page, set_, single = self.get_query_set(), None, None, None
+        inline_depth = self.get_inline_depth()
+        exclude = self.get_exclude()
 
         if 'pk' in self.kwargs:
-            single = get_object_or_404(queryset, pk=self.kwargs['pk'])
+            single = get_object_or_404(
+                self.optimize_queryset(queryset, inline_depth, exclude),
+                pk=self.kwargs['pk'])
 
         elif 'pks' in self.kwargs:
-            pks = set(pk for pk in self.kwargs['pks'].split(';') if pk)
-            set_ = queryset.in_bulk(pks).values()
+            pks = self.requested_pks()
+            if len(pks) > self.max_set_size:
+                raise ClientError('Cannot fetch more than %s objects at once.' % (
+                    self.max_set_size))
+
+            try:
+                pks = [self.model._meta.pk.to_python(pk) for pk in pks]
+            except ValidationError:
+                raise Http404('Some objects do not exist.')
+
+            # One query, returned in the order the primary keys were requested
+            instances = dict((obj.pk, obj) for obj in self.optimize_queryset(
+                queryset, inline_depth, exclude, prefetch=not self.streaming,
+                ).filter(pk__in=pks))
 
-            if len(pks) != len(set_):
+            if len(pks) != len(instances):
                 raise Http404('Some objects do not exist.')
 
+            set_ = [instances[pk] for pk in pks]
+
         else:
             queryset = self.apply_filters(queryset)
+            limit = self.get_limit()
 
-            try:
-                offset = int(self.request.GET.get('offset'))
-            except (TypeError, ValueError):
-                offset = 0
-
-            try:
-                limit = int(self.request.GET.get('limit'))
-            except (TypeError, ValueError):
-                limit = self.limit_per_page
+            # serialize_objects prefetches chunk by chunk when streaming
+            page_queryset = self.optimize_queryset(queryset, inline_depth,
+                exclude, prefetch=not self.streaming)
 
-            # Do not allow more than max_limit_per_page entries in one request, ever
-            limit = min(limit, self.max_limit_per_page)
+            if self.pagination == 'cursor':
+                page = self.cursor_page(page_queryset, limit)
 
-            # Sanitize range
-            offset = max(offset, 0)
-            limit = max(limit, 0)
+            else:
+                try:
+                    offset = int(self.request.GET.get('offset'))
+                except (TypeError, ValueError):
+                    offset = 0
+
+                # Sanitize range
+                offset = max(offset, 0)
+
+                if self.count_policy == 'exact':
+                    with self.measure('count'):
+                        total = self.count(queryset)
+                    items = page_queryset[offset:offset+limit]
+                    has_next = offset + limit < total
+                else:
+                    items = list(page_queryset[offset:offset+limit+1])
+                    has_next = len(items) > limit
+                    items = items[:limit]
+                    with self.measure('count'):
+                        total = self.count(queryset)
 
-            page = Page(
-                queryset[offset:offset+limit],
-                offset,
-                limit,
-                queryset.count(),
-                )
+                page = Page(items, offset, limit, total, has_next)
 
         return Objects(queryset, page, set_, single)
 
-    def get(self, request, *args, **kwargs):
+    def count(self, queryset):
         """
-        Processes GET requests by returning lists, sets or detail data. All of these
-        URLs are supported by this implementation:
+        Returns the total of ``queryset`` according to ``count_policy``
+        """
+        if self.count_policy == 'exact':
+            return queryset.count()
+        elif self.count_policy == 'estimate':
+            total = estimated_count(queryset)
+            if total is not None:
+                return total
+        elif self.count_policy != 'capped':
+            return None
 
-        - ``resource/``: Paginated list of objects, first page
-        - ``resource/?page=3``: Paginated list of objects, third page
-        - ``resource/42/``: Object with primary key of 42
-        - ``resource/1;3;5/``: Set of the three objects with a primary key of
+        total = capped_count(queryset, self.count_cap)
+        if total > self.count_cap:
+            return u'%s+' % self.count_cap
+        return total
+
+    def cursor_page(self, queryset, limit):
+        """
+        Returns a ``CursorPage`` for the ``after`` or ``before`` cursor passed
+        in the GET parameters (or the first page if neither is present).
+
+        One row more than requested is fetched to determine whether there are
+        more rows in the direction of pagination. No count is performed.
+        """
+        ordering = keyset_ordering(queryset)
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+
+        try:
+            if before:
+                values = decode_cursor(before, len(ordering))
+                queryset = queryset.order_by(*reverse_ordering(ordering)).filter(
+                    keyset_filter(ordering, values, reverse=True))
+            else:
+                queryset = queryset.order_by(*ordering)
+                if after:
+                    values = decode_cursor(after, len(ordering))
+                    queryset = queryset.filter(keyset_filter(ordering, values))
+        except (TypeError, ValueError, ValidationError):
+            # The cursor has the right shape, but values of the wrong type
+            raise ClientError('Invalid cursor')
+
+        items = list(queryset[:limit + 1])
+        has_more = len(items) > limit
+        items = items[:limit]
+
+        previous_cursor = next_cursor = None
+        if items:
+            if before:
+                items.reverse()
+                next_cursor = encode_cursor(keyset_values(items[-1], ordering))
+                if has_more:
+                    previous_cursor = encode_cursor(keyset_values(items[0], ordering))
+            else:
+                if after:
+                    previous_cursor = encode_cursor(keyset_values(items[0], ordering))
+                if has_more:
+                    next_cursor = encode_cursor(keyset_values(items[-1], ordering))
+
+        return CursorPage(items, limit, previous_cursor, next_cursor)
+
+    def get(self, request, *args, **kwargs):
+        """
+        Processes GET requests by returning lists, sets or detail data. All of these
+        URLs are supported by this implementation:
+
+        - ``resource/``: Paginated list of objects, first page
+        - ``resource/?page=3``: Paginated list of objects, third page
+        - ``resource/?after=<cursor>``: Paginated list of objects, the page after
+          the cursor (only if ``pagination = 'cursor'``, the cursors are
+          contained in the ``next`` and ``previous`` links in ``meta``)
+        - ``resource/42/``: Object with primary key of 42
+        - ``resource/1;3;5/``: Set of the three objects with a primary key of
           1, 3 and 5. The last item may have a semicolon too for simplicity, it
           will be ignored. The following URI would be equivalent: ``resource/1;;3;5;``
           (but it is bad style).
 
-        Filtering or searching is not supported at the moment.
+        Related objects are inlined if the ``full`` GET parameter is set
+        (``resource/42/?full=1``). The serialized fields can be restricted with
+        ``fields`` or ``exclude`` (``resource/?fields=name,price``); fields
+        listed in ``deferrable_fields`` are not loaded from the database either
+        if they are not needed.
+
+        Lists can be filtered and ordered as declared in ``filters``,
+        ``orderings`` and ``search_form``, see ``apply_filters``
+        (``resource/?category__in=1,2&order_by=-created``).
+
+        The prettified values in ``__pretty__`` can be skipped by passing
+        ``pretty=0``.
+
+        Complete lists can be downloaded using ``resource/export.ndjson`` or
+        ``resource/export.csv`` if ``export_allowed()``, see ``export()``.
         """
-        objects = self.objects()
+        if 'export' in self.kwargs:
+            return self.export(self.kwargs['export'])
+
+        with self.measure('objects'):
+            objects = self.objects()
+        inline_depth = self.get_inline_depth()
+        exclude = self.get_exclude()
+        pretty = self.get_pretty()
+
+        response = self.conditional_response(objects)
+        if response is not None:
+            return response
 
         if objects.single:
-            return self.api.serialize_instance(objects.single,
-                inline_depth=1 if request.GET.get('full') else 0)
+            with self.measure('serialize'):
+                data = self.api.serialize_instances([objects.single],
+                    inline_depth=inline_depth, exclude=exclude, pretty=pretty)[0]
+            if self.request_metrics is not None:
+                self.request_metrics.rows += 1
+            return data
         elif objects.set:
             return {
-                'objects': [self.api.serialize_instance(instance) for instance in objects.set],
+                'objects': self.serialize_objects(objects.set, inline_depth,
+                    exclude, pretty),
                 }
         else:
-            page = objects.page
-            list_url = api_reverse(objects.queryset.model, 'list', api_name=self.api.name)
+            return {
+                'objects': self.serialize_objects(objects.page.queryset,
+                    inline_depth, exclude, pretty),
+                'meta': self.page_meta(objects),
+                }
+
+    def conditional_response(self, objects):
+        """
+        Determines the ``ETag`` and ``Last-Modified`` headers using
+        ``validator``, adds them to ``response_headers`` and returns a
+        ``304 Not Modified`` response if the client already has the current
+        representation. Returns ``None`` otherwise.
+        """
+        if self.validator is None:
+            return None
+
+        etag, last_modified = self.validator(self, objects)
+
+        if etag is not None:
+            # The representation depends on the URL and the requested format
+            etag = hashlib.md5(u'|'.join((
+                force_unicode(etag),
+                self.request.get_full_path(),
+                self.request.META.get('HTTP_ACCEPT', ''),
+                )).encode('utf-8')).hexdigest()
+            self.response_headers['ETag'] = quote_etag(etag)
+
+        if last_modified is not None:
+            if not isinstance(last_modified, datetime.datetime):
+                # Date fields, the day starts at midnight
+                last_modified = datetime.datetime.combine(last_modified,
+                    datetime.time())
+            last_modified = timegm(last_modified.utctimetuple())
+            self.response_headers['Last-Modified'] = http_date(last_modified)
+
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = parse_http_date_safe(
+            self.request.META.get('HTTP_IF_MODIFIED_SINCE'))
+
+        if if_none_match and etag is not None:
+            etags = parse_etags(if_none_match)
+            not_modified = etag in etags or '*' in etags
+        elif if_modified_since and last_modified is not None:
+            not_modified = last_modified <= if_modified_since
+        else:
+            not_modified = False
+
+        if not_modified:
+            response = HttpResponse(status=304)
+            # Like the full response, serialize_response() skips this one
+            patch_vary_headers(response, ('Accept',))
+            return response
+        return None
+
+    def serialize_objects(self, objects, inline_depth=0, exclude=(), pretty=True):
+        """
+        Serializes a list or queryset of instances. Returns a generator if
+        ``streaming`` is enabled, a list otherwise.
+        """
+        if not self.streaming:
+            with self.measure('fetch'):
+                # TransformQuerySet.iterator() runs the query and the transforms
+                objects = list(objects.iterator()
+                    if hasattr(objects, 'iterator') else objects)
+            with self.measure('serialize'):
+                data = self.api.serialize_instances(objects,
+                    inline_depth=inline_depth, exclude=exclude, pretty=pretty)
+            if self.request_metrics is not None:
+                self.request_metrics.rows += len(data)
+            return data
+
+        def serialize_chunk(chunk):
+            # Many to many relations are not prefetched by optimize_queryset
+            # when streaming, the whole page would have to be loaded first
+            prefetch_many_to_many(chunk, inline_depth, exclude)
+            return self.api.serialize_instances(chunk,
+                inline_depth=inline_depth, exclude=exclude, pretty=pretty)
+
+        if hasattr(objects, 'iterator'):
+            objects = objects.iterator()
+
+        return (data for chunk in chunked(objects, 100)
+            for data in serialize_chunk(chunk))
+
+    def page_meta(self, objects):
+        """
+        Returns the ``meta`` dictionary for list views containing pagination
+        information and links to the previous and next pages.
+        """
+        page = objects.page
+        list_url = api_reverse(objects.queryset.model, 'list', api_name=self.api.name)
+
+        if isinstance(page, CursorPage):
             meta = {
-                'offset': page.offset,
                 'limit': page.limit,
-                'total': page.total,
                 'previous': None,
                 'next': None,
                 }
 
-            if page.offset > 0:
+            if page.previous:
                 meta['previous'] = u'%s?%s' % (list_url, querystring(
                     self.request.GET,
-                    exclude=('offset', 'limit'),
-                    offset=max(0, page.offset - page.limit),
+                    exclude=('offset', 'limit', 'after', 'before'),
+                    before=page.previous,
                     limit=page.limit,
                     ))
 
-            if page.offset + page.limit < page.total:
+            if page.next:
                 meta['next'] = u'%s?%s' % (list_url, querystring(
                     self.request.GET,
-                    exclude=('offset', 'limit'),
-                    offset=page.offset + page.limit,
+                    exclude=('offset', 'limit', 'after', 'before'),
+                    after=page.next,
                     limit=page.limit,
                     ))
 
-            return {
-                'objects': [self.api.serialize_instance(instance) for instance in page.queryset],
-                'meta': meta,
-                }
+            return meta
+
+        meta = {
+            'offset': page.offset,
+            'limit': page.limit,
+            'total': page.total,
+            'previous': None,
+            'next': None,
+            }
+
+        if page.offset > 0:
+            meta['previous'] = u'%s?%s' % (list_url, querystring(
+                self.request.GET,
+                exclude=('offset', 'limit'),
+                offset=max(0, page.offset - page.limit),
+                limit=page.limit,
+                ))
+
+        if page.has_next:
+            meta['next'] = u'%s?%s' % (list_url, querystring(
+                self.request.GET,
+                exclude=('offset', 'limit'),
+                offset=page.offset + page.limit,
+                limit=page.limit,
+                ))
+
+        return meta
+
+    def export_allowed(self):
+        """
+        By default, exporting all objects through the API is not allowed.
+        """
+        return False
+
+    def export(self, format):
+        """
+        Streams the whole filtered list as NDJSON (one object per line) or CSV
+        (one column per field, related objects and lists are JSON encoded).
+        ``fields``, ``exclude`` and ``full`` are supported like in lists.
+
+        Objects are ordered by primary key and fetched in chunks of
+        ``export_chunk_size`` using keyset queries (``pk > last pk``), so
+        neither OFFSET nor ``count()`` queries are needed and at most one
+        chunk is held in memory. Interrupted exports can be resumed by
+        passing the last primary key received as ``after_pk``
+        (``resource/export.ndjson?after_pk=4711``).
+        """
+        if not self.export_allowed():
+            raise ClientError('Exporting objects is not allowed', status=403)
+
+        inline_depth = self.get_inline_depth()
+        pretty = self.get_pretty()
+        # The primary key is always exported to allow resuming
+        exclude = tuple(name for name in self.get_exclude()
+            if name != self.model._meta.pk.name)
+
+        queryset = self.optimize_queryset(
+            self.apply_filters(self.get_query_set()).order_by('pk'),
+            inline_depth, exclude)
+
+        after_pk = self.request.GET.get('after_pk')
+        if after_pk:
+            try:
+                queryset = queryset.filter(
+                    pk__gt=self.model._meta.pk.to_python(after_pk))
+            except ValidationError:
+                raise ClientError('Invalid after_pk')
+
+        def chunks():
+            chunk_queryset = queryset
+            while True:
+                instances = list(chunk_queryset[:self.export_chunk_size].iterator())
+                if not instances:
+                    break
+
+                yield [data for data in self.api.serialize_instances(instances,
+                    inline_depth=inline_depth, exclude=exclude, pretty=pretty)
+                    if data]
+
+                if len(instances) < self.export_chunk_size:
+                    break
+                chunk_queryset = queryset.filter(pk__gt=instances[-1].pk)
+
+        opts = self.model._meta
+        if format == 'csv':
+            content, content_type = iter_csv(chunks(),
+                ['__uri__', '__unicode__'] + [f.name for f in opts.fields
+                    if f.name not in exclude]), 'text/csv; charset=utf-8'
+        else:
+            content, content_type = iter_ndjson(chunks()), 'application/x-ndjson'
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+            opts.module_name, format)
+        return response
+
+    def adding_allowed(self):
+        """
+        By default, adding objects through the API is not allowed.
+        """
+        return False
+
+    def editing_allowed(self):
+        """
+        By default, editing objects through the API is not allowed.
+        """
+        return False
+
+    def deletion_allowed(self):
+        """
+        By default, deleting objects through the API is not allowed.
+        """
+        return False
+
+    def get_form_class(self):
+        """
+        Returns the form class used for validating objects in bulk writes
+        """
+        return self.form_class or modelform_factory(self.model)
+
+    def requested_pks(self):
+        """
+        Returns the primary keys referenced by single object and set URIs in
+        the requested order (without duplicates), or ``None`` for list URIs.
+        """
+        if 'pk' in self.kwargs:
+            return [self.kwargs['pk']]
+        elif 'pks' in self.kwargs:
+            pks = []
+            for pk in self.kwargs['pks'].split(';'):
+                if pk and pk not in pks:
+                    pks.append(pk)
+            return pks
+        return None
+
+    def post(self, request, *args, **kwargs):
+        """
+        Creates objects in bulk. The request body should contain either a list
+        of objects or a dictionary with the list in ``objects``::
+
+            POST resource/
+            {"objects": [{"name": "First"}, {"name": "Second"}]}
+
+        All objects are validated using ``get_form_class()`` first. If any
+        object is invalid nothing is saved, and the validation errors are
+        returned per object index. Otherwise, the objects are created using
+        ``bulk_create`` inside a transaction. Note that ``save()`` is not called
+        and no signals are sent by ``bulk_create``, and that many to many values
+        are not saved.
+        """
+        if self.requested_pks() is not None or 'export' in self.kwargs:
+            raise ClientError('Objects can only be created through the list URI',
+                status=405)
+
+        if not self.adding_allowed():
+            raise ClientError('Adding objects is not allowed', status=403)
+
+        data = self.data
+        if isinstance(data, dict):
+            data = data.get('objects', [data])
+        if not isinstance(data, list):
+            raise ClientError('Expected a list of objects')
+        if len(data) > self.max_limit_per_page:
+            raise ClientError('Cannot create more than %s objects at once' % (
+                self.max_limit_per_page), status=413)
+
+        form_class = self.get_form_class()
+        forms, errors = [], []
+        for index, row in enumerate(data):
+            form = form_class(data=row)
+            if not form.is_valid():
+                errors.append({'index': index, 'errors': form.errors})
+            forms.append(form)
+
+        if errors:
+            raise ClientError('Validation failed', errors=errors)
+
+        with transaction.commit_on_success():
+            self.model._default_manager.bulk_create(
+                [form.save(commit=False) for form in forms])
+
+        return self.serialize_response({'created': len(forms)}, status=201)
+
+    def patch(self, request, *args, **kwargs):
+        """
+        Updates all objects referenced by a single object or set URI with the
+        field values contained in the request body::
+
+            PATCH resource/1;2;3/
+            {"is_active": false}
+
+        Every object is validated separately with the new values. If any
+        object is invalid nothing is saved and the validation errors are
+        returned per primary key. Otherwise, the objects are updated with
+        one ``update()`` call inside a transaction (``save()`` is not called,
+        cached serializations are invalidated nevertheless).
+        """
+        pks = self.requested_pks()
+        if pks is None:
+            raise ClientError('Objects can only be updated through set URIs',
+                status=405)
+
+        if not self.editing_allowed():
+            raise ClientError('Editing objects is not allowed', status=403)
+
+        values = self.data
+        if not isinstance(values, dict) or not values:
+            raise ClientError('Expected a dictionary of field values')
+        elif isinstance(values, QueryDict):
+            # Form encoded body, use the last value of every field
+            values = dict(values.items())
+
+        queryset = self.get_query_set().filter(pk__in=pks)
+        instances = list(queryset)
+        if len(instances) != len(pks):
+            raise Http404('Some objects do not exist.')
+
+        form_class = self.get_form_class()
+        many_to_many = [f.name for f in self.model._meta.many_to_many]
+        fields = [field for field in values if field not in ('pk', 'id')]
+
+        for field in fields:
+            if field not in form_class.base_fields:
+                raise ClientError('Unknown field %r' % field)
+            elif field in many_to_many:
+                raise ClientError(
+                    'Many to many fields cannot be updated in bulk (%r)' % field)
+
+        forms, errors = [], []
+        for instance in instances:
+            row = model_to_dict(instance, fields=form_class.base_fields.keys())
+            row.update(values)
+            form = form_class(data=row, instance=instance)
+            if not form.is_valid():
+                errors.append({'pk': instance.pk, 'errors': form.errors})
+            forms.append(form)
+
+        if errors:
+            raise ClientError('Validation failed', errors=errors)
+
+        with transaction.commit_on_success():
+            updated = queryset.update(**dict(
+                (field, forms[0].cleaned_data[field]) for field in fields))
+
+        # update() does not send post_save
+        if self.api.cache is not None:
+            self.api.cache.instances_changed(self.model,
+                [instance.pk for instance in instances])
+
+        return {'updated': updated}
+
+    def delete(self, request, *args, **kwargs):
+        """
+        Deletes all objects referenced by a single object or set URI inside
+        a transaction. Responds with ``404 Not Found`` without deleting
+        anything if some objects do not exist.
+        """
+        pks = self.requested_pks()
+        if pks is None:
+            raise ClientError('Objects can only be deleted through set URIs',
+                status=405)
+
+        if not self.deletion_allowed():
+            raise ClientError('Deleting objects is not allowed', status=403)
+
+        queryset = self.get_query_set().filter(pk__in=pks)
+
+        with transaction.commit_on_success():
+            if queryset.count() != len(pks):
+                raise Http404('Some objects do not exist.')
+            queryset.delete()
+
+        return HttpResponse(status=204)
+
+
+#: Available JSON encoding functions, see ``register_json_backend``
+JSON_BACKENDS = {}
+
+
+def register_json_backend(name, dumps):
+    """
+    Registers a JSON encoding function under ``name``. ``dumps`` is called with
+    the data to encode and has to return a string. It should use
+    ``json_default`` for types not natively supported by JSON so that the
+    output stays equivalent to that of Django's ``DjangoJSONEncoder``.
+
+    The backend is selected through the ``TOWEL_API_JSON_BACKEND`` setting::
+
+        TOWEL_API_JSON_BACKEND = 'simplejson'
+
+    Backends available out of the box are ``json`` (the standard library,
+    the default) and ``simplejson`` (if installed). No faster backend is
+    provided: ``simplejson`` is not faster than the standard library for
+    typical pages, and encoders without ``default`` argument (``ujson``,
+    ``cjson``) are slower once dates, decimals and lazy strings have been
+    converted in Python (see ``benchmarks/json_backends.py``).
+    """
+    JSON_BACKENDS[name] = dumps
+
+
+def json_backend():
+    """
+    Returns the encoding function of the JSON backend selected with the
+    ``TOWEL_API_JSON_BACKEND`` setting. Falls back to the standard library
+    if the backend is not available.
+    """
+    name = getattr(settings, 'TOWEL_API_JSON_BACKEND', 'json')
+    return JSON_BACKENDS.get(name) or JSON_BACKENDS['json']
+
+
+_django_json_encoder = DjangoJSONEncoder()
+
+
+def json_default(o):
+    """
+    Encodes dates, times and decimals exactly like ``DjangoJSONEncoder``, and
+    lazy translation strings as unicode strings. Usable as ``default``
+    argument for most JSON encoders.
+    """
+    if isinstance(o, Promise):
+        return force_unicode(o)
+    return _django_json_encoder.default(o)
+
+
+register_json_backend('json',
+    lambda data: json.dumps(data, default=json_default))
+
+try:
+    import simplejson
+except ImportError:
+    pass
+else:
+    # simplejson would encode decimals as numbers
+    register_json_backend('simplejson',
+        lambda data: simplejson.dumps(data, default=json_default, use_decimal=False))
+
+
+class LastModifiedValidator(object):
+    """
+    ``Resource.validator`` using the most recent value of a date or
+    datetime field (f.e. ``updated_at``) as ``Last-Modified`` value. For
+    lists the maximum is determined over the whole filtered queryset using
+    one aggregate query, therefore the field should be indexed. Deleted
+    objects do not change the value.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.fields = (field,)
+
+    def __call__(self, resource, objects):
+        if objects.single:
+            return None, getattr(objects.single, self.field)
+        elif objects.set:
+            return None, max(getattr(obj, self.field) for obj in objects.set)
+        return None, objects.queryset.aggregate(
+            last_modified=Max(self.field))['last_modified']
+
+
+class VersionValidator(object):
+    """
+    ``Resource.validator`` computing an ``ETag`` from the primary keys of
+    the objects in the response and the values of ``field`` (f.e. a version
+    counter or a modification timestamp, optional). For lists only the
+    primary keys and ``field`` values of the current page are fetched.
+    """
+
+    def __init__(self, field=None):
+        self.field = field
+        self.fields = ('pk', field) if field else ('pk',)
+
+    def _values(self, instance):
+        return tuple(getattr(instance, field) for field in self.fields)
+
+    def __call__(self, resource, objects):
+        if objects.single:
+            values = [self._values(objects.single)]
+            total = None
+        elif objects.set:
+            values = [self._values(obj) for obj in objects.set]
+            total = None
+        else:
+            page = objects.page
+            if hasattr(page.queryset, 'values_list'):
+                values = list(page.queryset.values_list(*self.fields))
+            else:
+                values = [self._values(obj) for obj in page.queryset]
+            total = getattr(page, 'total', None)
+
+        return hashlib.md5(repr((values, total))).hexdigest(), None
+
+
+class RateLimit(object):
+    """
+    Token bucket rate limiter for ``Resource.rate_limit``, backed by Django's
+    cache framework. Clients may make ``burst`` requests (defaults to
+    ``rate``) at once, the bucket is refilled with ``rate`` tokens every
+    ``per`` seconds. Expensive requests consume more than one token, see
+    ``Resource.request_cost()``.
+
+    If ``concurrency`` is set, only that many requests of one client are
+    processed at the same time. Streamed responses hold their slot until the
+    response body has been sent or the connection has been closed.
+
+    The limiter needs a cache shared by all processes (memcached, redis) to
+    be effective. Updates of the bucket are not atomic; concurrent requests
+    of one client may occasionally both be allowed.
+    """
+
+    def __init__(self, rate, per=60, burst=None, concurrency=None,
+            cache='default'):
+        self.rate = rate
+        self.per = per
+        self.burst = burst or rate
+        self.concurrency = concurrency
+        self.cache = get_cache(cache) if isinstance(cache, basestring) else cache
+
+    def client_key(self, request):
+        """
+        Identifies the client by its API key (the ``X-API-Key`` header),
+        the authenticated user or the remote address, in that order.
+        """
+        api_key = request.META.get('HTTP_X_API_KEY')
+        if api_key:
+            return 'key:%s' % hashlib.md5(api_key).hexdigest()
+
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            return 'user:%s' % user.pk
+
+        return 'addr:%s' % request.META.get('REMOTE_ADDR')
+
+    def consume(self, key, cost=1):
+        """
+        Takes ``cost`` tokens from the bucket identified by ``key``. Returns
+        ``0`` if the request is allowed, the number of seconds the client has
+        to wait otherwise.
+        """
+        key = 'towel-api-rate:%s' % key
+        now = time.time()
+        cost = min(cost, self.burst)
+
+        tokens, timestamp = self.cache.get(key) or (self.burst, now)
+        tokens = min(self.burst,
+            tokens + (now - timestamp) * self.rate / float(self.per))
+
+        if tokens >= cost:
+            tokens -= cost
+            retry_after = 0
+        else:
+            retry_after = int(math.ceil(
+                (cost - tokens) * self.per / float(self.rate)))
+
+        # Keep the bucket around until it would be full again
+        self.cache.set(key, (tokens, now),
+            int(math.ceil(self.burst * self.per / float(self.rate))) + 1)
+        return retry_after
+
+    def acquire(self, key):
+        """
+        Acquires a slot of the concurrency budget of ``key``. Returns whether
+        the request may be processed. Does nothing if ``concurrency`` is unset.
+        """
+        if not self.concurrency:
+            return True
+
+        cache_key = 'towel-api-concurrency:%s' % key
+        # The timeout protects against slots which are never released because
+        # the process died
+        self.cache.add(cache_key, 0, 300)
+        try:
+            running = self.cache.incr(cache_key)
+        except ValueError: # Evicted in the meantime
+            self.cache.set(cache_key, 1, 300)
+            running = 1
+
+        if running > self.concurrency:
+            self.release(key)
+            return False
+        return True
+
+    def release(self, key):
+        """
+        Releases a slot acquired with ``acquire()``.
+        """
+        if not self.concurrency:
+            return
+
+        try:
+            self.cache.decr('towel-api-concurrency:%s' % key)
+        except ValueError:
+            pass
+
+
+class RequestMetrics(object):
+    """
+    Metrics of one request processed by a ``Resource``: wall clock time per
+    phase, number of SQL queries, number of serialized objects and size of
+    the response body in bytes.
+
+    SQL queries are counted by enabling the debug cursor on all database
+    connections while the request is processed, which also works with
+    ``DEBUG = False``.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.queries = 0
+        self.rows = 0
+        self.bytes = None
+        self.started = time.time()
+        self.total = None
+
+        self._connections = []
+        for connection in connections.all():
+            self._connections.append((connection,
+                connection.use_debug_cursor, len(connection.queries)))
+            connection.use_debug_cursor = True
+
+    def add_time(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def finish(self):
+        self.total = time.time() - self.started
+        for connection, use_debug_cursor, queries in self._connections:
+            self.queries += len(connection.queries) - queries
+            connection.use_debug_cursor = use_debug_cursor
+        self._connections = []
+
+    def as_dict(self):
+        """
+        Returns the metrics as a ``dict``, timings are in milliseconds.
+        """
+        return {
+            'total': round(self.total * 1000, 2),
+            'timings': dict((phase, round(seconds * 1000, 2))
+                for phase, seconds in self.timings.items()),
+            'queries': self.queries,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            }
+
+    def header(self):
+        """
+        Returns the value of the ``X-API-Metrics`` header, f.e.
+        ``total=12.5ms, objects=3.1ms, queries=2, rows=20, bytes=4096``
+        """
+        data = self.as_dict()
+        parts = ['total=%sms' % data['total']]
+        parts.extend('%s=%sms' % item for item in sorted(data['timings'].items()))
+        parts.extend('%s=%s' % (key, data[key])
+            for key in ('queries', 'rows', 'bytes') if data[key] is not None)
+        return ', '.join(parts)
+
+
+class LoggingMetricsSink(object):
+    """
+    ``Resource.metrics`` sink writing one log record per request.
+    """
+
+    def __init__(self, logger='towel.api', level=logging.INFO):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def __call__(self, resource, data):
+        self.logger.log(self.level,
+            '%(method)s %(resource)s %(status)s: %(total)sms, %(queries)s queries,'
+            ' %(rows)s rows, %(bytes)s bytes, timings %(timings)s', data,
+            extra={'metrics': data})
+
+
+class StatsdMetricsSink(object):
+    """
+    ``Resource.metrics`` sink sending timers and counters to a statsd
+    compatible daemon using UDP. Metric names are
+    ``<prefix>.<app_label>.<model>.<metric>``. Sending errors are ignored.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='towel.api'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, resource, data):
+        prefix = '%s.%s' % (self.prefix, data['resource'])
+        lines = ['%s.total:%s|ms' % (prefix, data['total'])]
+        lines.extend('%s.%s:%s|ms' % (prefix, phase, value)
+            for phase, value in data['timings'].items())
+        lines.extend('%s.%s:%s|c' % (prefix, key, data[key])
+            for key in ('queries', 'rows', 'bytes') if data[key] is not None)
+
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+
+class RingBufferMetricsSink(object):
+    """
+    ``Resource.metrics`` sink keeping the metrics of the last ``size``
+    requests in memory (per process), f.e. for a debugging view::
+
+        sink = RingBufferMetricsSink(500)
+        api.register(Product, view_init={'metrics': sink})
+
+        slowest = sorted(sink.entries, key=lambda data: -data['total'])[:10]
+    """
+
+    def __init__(self, size=1000):
+        self.entries = deque(maxlen=size)
+
+    def __call__(self, resource, data):
+        self.entries.append(data)
+
+
+def is_streaming(data):
+    """
+    Returns whether ``data`` (the return value of a ``Resource`` processing
+    method or a response) is streamed to the client.
+    """
+    if isinstance(data, HttpResponse):
+        if hasattr(data, 'streaming'):
+            return data.streaming
+        # Django < 1.5 does not have StreamingHttpResponse, the content of
+        # responses is stored in a list unless it is an iterator. Reading
+        # ``content`` of the latter would consume the iterator.
+        return not isinstance(getattr(data, '_container', None), list)
+    return isinstance(data, dict) and any(
+        isinstance(value, types.GeneratorType) for value in data.values())
+
+
+class CallbackIterator(object):
+    """
+    Iterates over ``iterable`` and calls ``callback`` once, as soon as the
+    iterable is exhausted, raises an exception or the iterator is closed.
+    """
+
+    def __init__(self, iterable, callback):
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self.callback = callback
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.iterator.next()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        callback, self.callback = self.callback, None
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            if callback is not None:
+                callback()
+
+
+def call_when_streamed(response, callback):
+    """
+    Calls ``callback`` after the body of the streamed ``response`` has been
+    produced. The WSGI server closes the response if the client goes away,
+    ``callback`` is called in this case too.
+    """
+    if hasattr(response, 'streaming_content'):
+        response.streaming_content = CallbackIterator(
+            response.streaming_content, callback)
+    else:
+        # Django < 1.5, HttpResponse.close() closes the iterator
+        response._container = CallbackIterator(response._container, callback)
+
+
+def json_response(data, status=200):
+    """
+    Returns a ``HttpResponse`` containing ``data`` encoded as JSON. If ``data``
+    is a ``dict`` containing generators (f.e. ``objects`` in lists returned by
+    a ``Resource`` with ``streaming = True``) a streaming response is returned.
+    """
+    if is_streaming(data):
+        return StreamingHttpResponse(iter_json(data),
+            content_type='application/json', status=status)
+
+    return HttpResponse(json_backend()(data),
+        mimetype='application/json', status=status)
+
+
+def iter_ndjson(chunks):
+    """
+    Encodes the lists of objects yielded by ``chunks`` as newline delimited
+    JSON, yielding one string per chunk.
+    """
+    dumps = json_backend()
+    for chunk in chunks:
+        yield ''.join('%s\n' % dumps(data) for data in chunk)
+
+
+def iter_csv(chunks, columns):
+    """
+    Encodes the lists of objects yielded by ``chunks`` as CSV with the given
+    ``columns`` and a header row, yielding one string per chunk. Values which
+    are not strings or numbers are JSON encoded.
+    """
+    dumps = json_backend()
+
+    def encode(value):
+        if value is None:
+            return ''
+        elif isinstance(value, unicode):
+            return value.encode('utf-8')
+        elif isinstance(value, (str, int, long, float)):
+            return value
+        elif isinstance(value, (dict, list, tuple)):
+            return dumps(value)
+        return force_unicode(json_default(value)).encode('utf-8')
+
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+
+    for chunk in chunks:
+        for data in chunk:
+            writer.writerow([encode(data.get(column)) for column in columns])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def iter_json(data, chunk_size=16384):
+    """
+    Encodes the ``dict`` ``data`` as JSON piece by piece. Generators are
+    encoded item by item as JSON arrays, all other values are encoded as a
+    whole. Yields chunks of approximately ``chunk_size`` bytes.
+    """
+    dumps = json_backend()
+    buf, size = [], 0
+
+    def pieces():
+        yield '{'
+        for i, (key, value) in enumerate(data.items()):
+            if i:
+                yield ', '
+            yield dumps(key)
+            yield ': '
+
+            if isinstance(value, types.GeneratorType):
+                yield '['
+                for j, item in enumerate(value):
+                    if j:
+                        yield ', '
+                    yield dumps(item)
+                yield ']'
+            else:
+                yield dumps(value)
+        yield '}'
+
+    for piece in pieces():
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf, size = [], 0
+
+    if buf:
+        yield ''.join(buf)
+
+
+#: Available request body parsers, see ``register_parser``
+PARSERS = {}
+
+
+def register_parser(mimetype, parser):
+    """
+    Registers a parser for request bodies of content type ``mimetype``.
+    ``parser`` is called with the request and has to return the decoded
+    body, and should raise ``ValueError`` if the body is invalid::
+
+        register_parser('application/x-yaml',
+            lambda request: yaml.safe_load(request.body))
+
+    Parsers available out of the box handle JSON, form encoded and multipart
+    bodies (uploaded files are available in ``request.FILES`` for ``POST``
+    requests) and MessagePack (if the ``msgpack`` package is installed).
+    """
+    PARSERS[mimetype] = parser
+
+
+def parse_form(request):
+    """
+    Parses form encoded request bodies. Django only parses ``POST`` requests.
+    """
+    if request.method == 'POST':
+        return request.POST
+    return QueryDict(request.body, encoding=request.encoding)
+
+
+def parse_multipart(request):
+    """
+    Parses multipart request bodies. Django only parses ``POST`` requests.
+    """
+    try:
+        if request.method == 'POST':
+            return request.POST
+        return request.parse_file_upload(request.META, request)[0]
+    except MultiPartParserError as e:
+        raise ValueError(e)
+
+
+register_parser('application/json', lambda request: json.loads(request.body))
+register_parser('application/x-www-form-urlencoded', parse_form)
+register_parser('multipart/form-data', parse_multipart)
+
+
+def cbor_response(data, status=200):
+    """
+    Returns a ``HttpResponse`` containing ``data`` encoded as CBOR using the
+    bundled encoder ``towel.cbor``. Generators are streamed as
+    indefinite-length arrays.
+    """
+    if is_streaming(data):
+        return StreamingHttpResponse(
+            cbor.iter_dumps(data, default=json_default),
+            content_type='application/cbor', status=status)
+
+    return HttpResponse(cbor.dumps(data, default=json_default),
+        mimetype='application/cbor', status=status)
+
+
+#: Available response formats as ``(mimetype, handler)`` tuples in order of
+#: preference, see ``register_format``
+FORMATS = []
+
+
+def register_format(mimetype, handler):
+    """
+    Registers a response format. ``handler`` is called with the data returned
+    by the ``Resource`` processing methods and the response status as keyword
+    argument ``status``, and has to return a ``HttpResponse``. Registering a
+    mimetype again replaces its handler. Values not natively supported by the
+    format should be converted using ``json_default`` so that all formats
+    transport the same data::
+
+        register_format('application/x-yaml', lambda data, status=200: (
+            HttpResponse(yaml.safe_dump(data), status=status,
+                mimetype='application/x-yaml')))
+
+    Formats available out of the box are JSON (the default), CBOR and
+    MessagePack (if the ``msgpack`` package is installed).
+    """
+    for i, (format, old_handler) in enumerate(FORMATS):
+        if format == mimetype:
+            FORMATS[i] = (mimetype, handler)
+            break
+    else:
+        FORMATS.append((mimetype, handler))
+
+
+register_format('application/json', json_response)
+register_format('application/cbor', cbor_response)
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    def msgpack_response(data, status=200):
+        """
+        Returns a ``HttpResponse`` containing ``data`` encoded as MessagePack.
+        MessagePack has no indefinite-length arrays, generators are
+        therefore consumed before encoding.
+        """
+        if is_streaming(data):
+            data = dict((key, list(value) if isinstance(
+                value, types.GeneratorType) else value)
+                for key, value in data.items())
+
+        return HttpResponse(
+            # Byte strings (f.e. URIs) are text, as in JSON and CBOR
+            msgpack.packb(data, default=json_default, use_bin_type=False),
+            mimetype='application/x-msgpack', status=status)
+
+    def parse_msgpack(request):
+        """
+        Parses MessagePack request bodies
+        """
+        try:
+            return msgpack.unpackb(request.body, raw=False)
+        except Exception as e: # msgpack raises various exception types
+            raise ValueError(e)
+
+    register_format('application/x-msgpack', msgpack_response)
+    register_parser('application/x-msgpack', parse_msgpack)
+
+
+def capped_count(queryset, cap):
+    """
+    Counts the objects in ``queryset``, but stops counting after ``cap + 1``
+    objects. Only the primary keys of at most ``cap + 1`` rows are fetched.
+    """
+    return len(queryset.order_by().values_list('pk', flat=True)[:cap + 1])
+
+
+def estimated_count(queryset):
+    """
+    Returns the number of rows the query planner expects ``queryset`` to
+    return, or ``None`` if the database does not offer estimates (only
+    PostgreSQL does at the moment). For unfiltered querysets this is
+    the ``pg_class.reltuples`` value maintained by ``ANALYZE``.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    try:
+        sql, params = queryset.order_by().query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return 0
+
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN %s' % sql, params)
+    match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+    return int(match.group(1)) if match else None
+
+
+def _cursor_default(o):
+    if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+        # Do not lose precision as DjangoJSONEncoder does
+        return o.isoformat()
+    elif isinstance(o, decimal.Decimal):
+        return str(o)
+    raise TypeError('%r is not JSON serializable' % o)
+
+
+def encode_cursor(values):
+    """
+    Encodes the ordering values of a row into an opaque cursor for use in
+    URLs
+    """
+    data = json.dumps(values, default=_cursor_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """
+    Decodes a cursor created by ``encode_cursor``, raises a ``ClientError`` if
+    the cursor is malformed or does not contain ``length`` values.
+    """
+    try:
+        cursor = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise ClientError('Invalid cursor')
+
+    if not isinstance(values, list) or len(values) != length:
+        raise ClientError('Invalid cursor')
+    return values
 
 
 def querystring(data, exclude=(), **kwargs):
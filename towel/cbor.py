@@ -0,0 +1,162 @@
+"""
+Minimal pure Python CBOR (RFC 7049) encoder
+===========================================
+
+Supports everything the serializers in ``towel.api`` produce: ``None``,
+booleans, integers of any size, floats, unicode and byte strings, lists,
+tuples and dictionaries. Generators are encoded as indefinite-length
+arrays, which allows streaming long lists with ``iter_dumps``. Values of
+other types are passed to ``default`` which has to return an encodable
+value (f.e. ``towel.api.json_default``).
+
+Usage::
+
+    from towel import cbor
+
+    data = cbor.dumps({'objects': [1, 2, 3]})
+
+    for chunk in cbor.iter_dumps({'objects': (i for i in range(10000))}):
+        response.write(chunk)
+
+Byte strings which are valid UTF-8 are encoded as text strings, since
+Python 2 code uses them interchangeably with unicode strings.
+"""
+
+import struct
+import types
+
+
+_pack_byte = struct.Struct('>B').pack
+_pack_short = struct.Struct('>H').pack
+_pack_int = struct.Struct('>I').pack
+_pack_long = struct.Struct('>Q').pack
+_pack_double = struct.Struct('>d').pack
+
+_SIMPLE = {None: '\xf6', True: '\xf5', False: '\xf4'}
+_BREAK = '\xff'
+_INDEFINITE_ARRAY = '\x9f'
+
+
+def _head(major, value):
+    """
+    Returns the initial byte(s) of a data item of type ``major`` with
+    argument ``value`` (a length or an unsigned integer)
+    """
+    major <<= 5
+    if value < 24:
+        return chr(major | value)
+    elif value < 0x100:
+        return chr(major | 24) + _pack_byte(value)
+    elif value < 0x10000:
+        return chr(major | 25) + _pack_short(value)
+    elif value < 0x100000000:
+        return chr(major | 26) + _pack_int(value)
+    return chr(major | 27) + _pack_long(value)
+
+
+def _encode_int(value):
+    major = 0
+    if value < 0:
+        major, value = 1, -1 - value
+
+    if value < 0x10000000000000000:
+        return _head(major, value)
+
+    # Bignums (tag 2 and 3), big-endian byte strings
+    data = []
+    while value:
+        data.append(chr(value & 0xff))
+        value >>= 8
+    data = ''.join(reversed(data))
+    return _head(6, 2 + major) + _head(2, len(data)) + data
+
+
+def _encode(obj, out, default):
+    """
+    Appends the encoded ``obj`` to the list ``out``
+    """
+    if obj is None or obj is True or obj is False:
+        out.append(_SIMPLE[obj])
+    elif isinstance(obj, unicode):
+        data = obj.encode('utf-8')
+        out.append(_head(3, len(data)))
+        out.append(data)
+    elif isinstance(obj, str):
+        try:
+            obj.decode('utf-8')
+        except UnicodeDecodeError:
+            out.append(_head(2, len(obj)))
+        else:
+            out.append(_head(3, len(obj)))
+        out.append(obj)
+    elif isinstance(obj, (int, long)):
+        out.append(_encode_int(obj))
+    elif isinstance(obj, float):
+        out.append('\xfb')
+        out.append(_pack_double(obj))
+    elif isinstance(obj, dict):
+        out.append(_head(5, len(obj)))
+        for key, value in obj.iteritems():
+            _encode(key, out, default)
+            _encode(value, out, default)
+    elif isinstance(obj, (list, tuple)):
+        out.append(_head(4, len(obj)))
+        for value in obj:
+            _encode(value, out, default)
+    elif isinstance(obj, types.GeneratorType):
+        out.append(_INDEFINITE_ARRAY)
+        for value in obj:
+            _encode(value, out, default)
+        out.append(_BREAK)
+    elif default is not None:
+        _encode(default(obj), out, default)
+    else:
+        raise TypeError('%r is not CBOR serializable' % obj)
+
+
+def dumps(obj, default=None):
+    """
+    Returns ``obj`` encoded as CBOR byte string
+    """
+    out = []
+    _encode(obj, out, default)
+    return ''.join(out)
+
+
+def iter_dumps(obj, default=None, chunk_size=16384):
+    """
+    Encodes ``obj`` piece by piece, yielding chunks of approximately
+    ``chunk_size`` bytes. Generators contained in dictionaries, lists and
+    tuples are consumed item by item.
+    """
+    buf, size = [], 0
+
+    def pieces(obj):
+        if isinstance(obj, types.GeneratorType):
+            yield _INDEFINITE_ARRAY
+            for value in obj:
+                yield dumps(value, default)
+            yield _BREAK
+        elif isinstance(obj, dict):
+            yield _head(5, len(obj))
+            for key, value in obj.iteritems():
+                yield dumps(key, default)
+                for piece in pieces(value):
+                    yield piece
+        elif isinstance(obj, (list, tuple)):
+            yield _head(4, len(obj))
+            for value in obj:
+                for piece in pieces(value):
+                    yield piece
+        else:
+            yield dumps(obj, default)
+
+    for piece in pieces(obj):
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf, size = [], 0
+
+    if buf:
+        yield ''.join(buf)
@@ -121,7 +121,8 @@ class SearchForm(forms.Form):
     """
     Supports persistence of searches (stores search in the session). Requires
     not only the GET parameters but the request object itself to work
-    correctly.
+    correctly. Pass ``persistent=False`` to neither store nor restore
+    searches.
 
     Usage example::
 
@@ -196,10 +197,16 @@ class SearchForm(forms.Form):
         self.persistency = False
 
         request = kwargs.pop('request')
+        persistent = kwargs.pop('persistent', True)
         self.original_data = data
         super(SearchForm, self).__init__(self.prepare_data(data, request),
             *args, **kwargs)
-        self.persist(request)
+
+        if persistent:
+            self.persist(request)
+        elif not (data and set(data.keys()) & set(self.fields.keys())):
+            self.filtered = False
+
         self.post_init(request)
 
     def prepare_data(self, data, request):
@@ -1,23 +1,29 @@
 from __future__ import with_statement
 
+from cStringIO import StringIO
+import csv
 import datetime
 import decimal
 import urllib
+import uuid
 
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.db import models, transaction
 from django.forms.formsets import all_valid
 from django.forms.models import modelform_factory
 from django.http import Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, redirect, render_to_response
-from django.template import RequestContext
+from django.template import loader, RequestContext
 from django.utils.encoding import force_unicode
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
 from towel import deletion, paginator
-from towel.utils import related_classes, safe_queryset_and
+from towel.utils import (chunked, related_classes, safe_queryset_and,
+    StreamingHttpResponse)
 
 
 def _tryreverse(*args, **kwargs):
@@ -60,6 +66,26 @@ class ModelView(object):
     #: By default, showing all objects on one page is allowed
     pagination_all_allowed = True
 
+    #: Showing all objects on one page is only allowed up to this many objects,
+    #: ``None`` means no limit. All objects are rendered in chunks (see
+    #: ``render_streaming``) even if ``streaming_lists`` is not set.
+    pagination_all_max = 1000
+
+    #: Format of the download offered instead of showing all objects if there
+    #: are more than ``pagination_all_max`` objects, ``'csv'`` (the default)
+    #: or ``'ndjson'``. ``None`` shows the current page and a notice instead.
+    pagination_all_download = 'csv'
+
+    #: Names of the fields contained in downloads besides the string
+    #: representation of the objects, see ``download_object_list``
+    download_fields = ()
+
+    #: Stream list views to the client, see ``render_list``
+    streaming_lists = False
+
+    #: Number of objects rendered at once by streaming list views
+    streaming_chunk_size = 100
+
     #: The paginator class used for pagination
     paginator_class = paginator.Paginator
 
@@ -419,16 +445,77 @@ class ModelView(object):
     def render(self, request, template, context):
         """
         Render the whole shebang.
+
+        Contexts containing a ``rows_marker`` (see ``render_list``) are
+        streamed using ``render_streaming``.
         """
+        if context.get('rows_marker'):
+            return self.render_streaming(request, template, context)
         return render_to_response(template, context)
 
-    def render_list(self, request, context):
+    def render_list(self, request, context, streaming=None):
         """
         Render the list view
+
+        The name of the template rendering the rows of the list is added to
+        the context as ``rows_template``. The response is streamed if
+        ``streaming`` is ``True`` (defaults to ``streaming_lists``), see
+        ``render_streaming``.
         """
+        if streaming is None:
+            streaming = self.streaming_lists
+
+        context = self.get_context(request, context)
+        context['rows_template'] = loader.select_template(
+            self.get_template(request, 'list_rows')).name
+        if streaming:
+            context['rows_marker'] = mark_safe(
+                '<!-- towel-rows-%s -->' % uuid.uuid4().hex)
+
         return self.render(request,
             self.get_template(request, 'list'),
-            self.get_context(request, context))
+            context)
+
+    def render_streaming(self, request, template, context):
+        """
+        Render a list view as streaming response. ``template`` is rendered
+        with the ``rows_marker`` variable in the context; templates supporting
+        streaming output the marker instead of the rows of the list. The
+        part before the marker is sent first, followed by the rows rendered
+        using ``rows_template`` in chunks of ``streaming_chunk_size`` objects
+        (querysets are fetched using ``iterator()``) and the rest of the
+        template. Templates without marker are sent as a whole.
+
+        Rows templates are rendered once per chunk, therefore ``forloop``
+        counters and ``{% cycle %}`` tags start over for every chunk. Errors
+        happening while rendering rows cannot be reported to the client
+        anymore, the response is cut off.
+        """
+        name = self.template_object_list_name
+        object_list = context[name]
+        marker = context['rows_marker']
+
+        template = loader.select_template(template)
+        rows_template = loader.get_template(context['rows_template'])
+
+        def content():
+            head, found, tail = template.render(context).partition(marker)
+            yield head
+
+            if found:
+                objects = (object_list.iterator()
+                    if hasattr(object_list, 'iterator') else object_list)
+                for chunk in chunked(objects, self.streaming_chunk_size):
+                    context.push()
+                    context[name] = chunk
+                    try:
+                        yield rows_template.render(context)
+                    finally:
+                        context.pop()
+
+                yield tail
+
+        return StreamingHttpResponse(content())
 
     def render_detail(self, request, context):
         """
@@ -512,7 +599,9 @@ class ModelView(object):
         """
         Helper which paginates the given object list
 
-        Skips pagination if the magic ``all`` GET parameter is set.
+        Skips pagination if the magic ``all`` GET parameter is set and there
+        are at most ``pagination_all_max`` objects. If there are more objects,
+        ``show_all_exceeded`` is set on the page instead.
         """
         paginator_obj = self.paginator_class(queryset, paginate_by)
 
@@ -527,10 +616,15 @@ class ModelView(object):
             page_obj = paginator_obj.page(paginator_obj.num_pages)
 
         if self.pagination_all_allowed and request.GET.get('all'):
-            page_obj.object_list = queryset
-            page_obj.show_all_objects = True
-            page_obj.start_index = 1
-            page_obj.end_index = paginator_obj.count
+            if self.pagination_all_max is not None and (
+                    getattr(paginator_obj, 'count_exceeded', False)
+                    or paginator_obj.count > self.pagination_all_max):
+                page_obj.show_all_exceeded = True
+            else:
+                page_obj.object_list = queryset
+                page_obj.show_all_objects = True
+                page_obj.start_index = 1
+                page_obj.end_index = paginator_obj.count
 
         return page_obj, paginator_obj
 
@@ -556,19 +650,89 @@ class ModelView(object):
             return response
 
         ctx['full_%s' % self.template_object_list_name] = queryset
+        streaming = None
 
         if self.paginate_by:
             page, paginator = self.paginate_object_list(request, queryset, self.paginate_by)
 
+            if getattr(page, 'show_all_exceeded', False) and self.pagination_all_download:
+                return self.download_object_list(request, queryset,
+                    self.pagination_all_download)
+
             ctx.update({
                 self.template_object_list_name: page.object_list,
                 'page': page,
                 'paginator': paginator,
                 })
+
+            if getattr(page, 'show_all_objects', False):
+                streaming = True
         else:
             ctx[self.template_object_list_name] = queryset
 
-        return self.render_list(request, ctx)
+        return self.render_list(request, ctx, streaming)
+
+    def download_object_list(self, request, queryset, format='csv'):
+        """
+        Streams all objects in ``queryset`` as CSV or NDJSON (one JSON object
+        per line) file. The objects are fetched using ``queryset.iterator()``
+        and encoded in chunks, the whole list is never held in memory.
+
+        Only the string representation of the objects and the fields listed
+        in ``download_fields`` are included.
+        """
+        opts = self.model._meta
+        fields = [opts.get_field(name) for name in self.download_fields]
+
+        def chunks():
+            return chunked(queryset.iterator(), 500)
+
+        if format == 'ndjson':
+            encoder = DjangoJSONEncoder()
+            native = (basestring, int, long, float, datetime.date,
+                datetime.time, decimal.Decimal, type(None))
+
+            def value(f, instance):
+                value = f.value_from_object(instance)
+                # File fields and custom field types
+                return value if isinstance(value, native) else f.value_to_string(instance)
+
+            def content():
+                for chunk in chunks():
+                    yield ''.join('%s\n' % encoder.encode(dict(
+                        [('__unicode__', force_unicode(instance))]
+                        + [(f.name, value(f, instance)) for f in fields]
+                        )) for instance in chunk)
+
+            content_type = 'application/x-ndjson'
+
+        else:
+            def encode(value):
+                return force_unicode(value).encode('utf-8')
+
+            def content():
+                buf = StringIO()
+                writer = csv.writer(buf)
+                writer.writerow([encode(opts.verbose_name)]
+                    + [encode(f.verbose_name) for f in fields])
+
+                for chunk in chunks():
+                    for instance in chunk:
+                        writer.writerow([encode(instance)]
+                            + [encode(f.value_to_string(instance)) for f in fields])
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+
+                if buf.tell():
+                    yield buf.getvalue()
+
+            format, content_type = 'csv', 'text/csv; charset=utf-8'
+
+        response = StreamingHttpResponse(content(), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+            opts.module_name, format)
+        return response
 
     def handle_search_form(self, request, ctx, queryset=None):
         """
@@ -20,13 +20,30 @@ The defaults are as follows::
         'END': 6, # pages at the end of the range
         'AROUND': 5, # pages around the current page
         }
+
+``KeysetPaginator`` is a drop-in replacement for ``Paginator`` for large
+tables which does not use ``OFFSET`` to fetch the objects of a page.
+
+Counting the objects of large or expensive querysets can be made cheaper
+by caching counts, by counting only up to a ceiling and by counting in the
+background, see ``Paginator``.
 """
 
+import hashlib
+import threading
+
 from django.conf import settings
 from django.core import paginator
+from django.core.cache import cache
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from towel.utils import (keyset_filter, keyset_ordering, keyset_values,
+    reverse_ordering)
 
 
-__all__ = ('InvalidPage', 'PageNotAnInteger', 'EmptyPage', 'Paginator', 'Page')
+__all__ = ('InvalidPage', 'PageNotAnInteger', 'EmptyPage', 'Paginator',
+    'KeysetPaginator', 'Page')
 
 
 # Import useful exceptions into the local scope
@@ -54,14 +71,216 @@ def filter_adjacent(iterable):
             yield item
 
 
+def query_cache_key(prefix, queryset, *args):
+    """
+    Returns a cache key for data derived from the SQL query of ``queryset``
+    (and ``args``)
+    """
+    try:
+        sql = repr(queryset.query.sql_with_params())
+    except EmptyResultSet:
+        sql = 'empty'
+    return '%s:%s' % (prefix, hashlib.md5(':'.join(
+        [sql] + [str(arg) for arg in args])).hexdigest())
+
+
 class Paginator(paginator.Paginator):
     """
     Custom paginator returning a Page object with an additional page_range
     method which can be used to implement Digg-style pagination
+
+    Counting can be customized by subclassing::
+
+        class SearchPaginator(Paginator):
+            count_cache_timeout = 300
+            count_ceiling = 5000
+            count_async = True
+
+    - ``count_cache_timeout``: Counts are cached for this many seconds in
+      Django's cache, keyed by the SQL query.
+    - ``count_ceiling``: Counting stops after this many objects. If there are
+      more objects, ``count`` is the ceiling and ``count_exceeded`` is set;
+      only the pages up to the ceiling can be reached, the page range ends
+      with an ellipsis instead of the last pages.
+    - ``count_async``: If the count is not cached yet, the exact count is
+      determined in a background thread and cached. In the meantime the
+      bounded count is used. Needs ``count_cache_timeout`` and
+      ``count_ceiling``.
     """
+
+    #: Cache counts for this many seconds, ``None`` disables caching
+    count_cache_timeout = None
+
+    #: Stop counting after this many objects, ``None`` counts all objects
+    count_ceiling = None
+
+    #: Determine uncached exact counts in a background thread
+    count_async = False
+
+    #: Whether there are more objects than ``count_ceiling``
+    count_exceeded = False
+
     def page(self, number):
         return Page(paginator.Paginator.page(self, number))
 
+    def _get_count(self):
+        if self._count is None:
+            if not hasattr(self.object_list, 'query'):
+                return paginator.Paginator._get_count(self)
+
+            if self.count_cache_timeout:
+                cache_key = query_cache_key('towel-paginator-count',
+                    self.object_list)
+                self._count = cache.get(cache_key)
+                if self._count is not None:
+                    return self._count
+
+            if self.count_ceiling is None:
+                self._count = self.object_list.count()
+            else:
+                count = len(self.object_list.order_by().values_list('pk')[
+                    :self.count_ceiling + 1])
+                if count > self.count_ceiling:
+                    if self.count_async and self.count_cache_timeout:
+                        self._count_in_background(cache_key)
+                    self._count = self.count_ceiling
+                    self.count_exceeded = True
+                    return self._count
+                self._count = count
+
+            if self.count_cache_timeout:
+                cache.set(cache_key, self._count, self.count_cache_timeout)
+        return self._count
+    count = property(_get_count)
+
+    def _count_in_background(self, cache_key):
+        """
+        Counts all objects in a separate thread and caches the result. Only
+        one thread is started per query at a time.
+        """
+        if not cache.add('%s:pending' % cache_key, 1, self.count_cache_timeout):
+            return
+
+        queryset = self.object_list._clone()
+        timeout = self.count_cache_timeout
+
+        def count():
+            try:
+                cache.set(cache_key, queryset.count(), timeout)
+            finally:
+                cache.delete('%s:pending' % cache_key)
+                # The thread has its own database connections
+                for connection in connections.all():
+                    connection.close()
+
+        thread = threading.Thread(target=count)
+        thread.daemon = True
+        thread.start()
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator fetching the objects of a page by keyset over the active
+    ordering of the queryset (see ``towel.utils.keyset_ordering``) instead of
+    using ``OFFSET``, which gets slower the further the database has to skip.
+    Usage in model views::
+
+        class ArticleModelView(ModelView):
+            paginate_by = 50
+            paginator_class = KeysetPaginator
+
+    Pages are still addressed by number, so the Digg-style page range and
+    the templates work as before. The key of the row before each visited
+    page is cached (for ``boundary_cache_timeout`` seconds, keyed by the SQL
+    query) together with the key of the row before the following page. The
+    key of a page which has not been visited is determined by skipping rows
+    from the nearest known boundary or from the end of the list, whichever
+    is closer; paging forward or backward, jumping to the last pages and
+    revisiting pages only needs to skip few or no rows at all.
+
+    The ordering columns should be indexed. Querysets with an ordering not
+    supported by keyset pagination and plain lists are paginated using
+    ``OFFSET`` as usual. Boundaries do not move when objects are added or
+    removed until the cache entry expires, pages may contain a few objects
+    more or less than ``per_page`` in the meantime.
+    """
+
+    #: Lifetime of cached page boundaries in seconds
+    boundary_cache_timeout = 300
+
+    def page(self, number):
+        try:
+            ordering = keyset_ordering(self.object_list)
+        except (AttributeError, ValueError):
+            return Paginator.page(self, number)
+
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count and not self.count_exceeded:
+            top = self.count
+
+        queryset = self.object_list.order_by(*ordering)
+        if self.num_pages == 1 and not self.count_exceeded:
+            return Page(paginator.Page(list(queryset[:top]), number, self))
+
+        cache_key = query_cache_key('towel-paginator', self.object_list,
+            self.per_page, self.orphans)
+        boundaries = cache.get(cache_key) or {}
+        changed = False
+
+        if number > 1:
+            if number not in boundaries:
+                try:
+                    boundaries[number] = self._boundary(number, queryset,
+                        ordering, boundaries)
+                except IndexError: # Rows have been deleted in the meantime
+                    return Paginator.page(self, number)
+                changed = True
+            queryset = queryset.filter(keyset_filter(ordering, boundaries[number]))
+
+        object_list = list(queryset[:top - bottom])
+
+        if object_list and number < self.num_pages and number + 1 not in boundaries:
+            boundaries[number + 1] = keyset_values(object_list[-1], ordering)
+            changed = True
+
+        if changed:
+            cache.set(cache_key, boundaries, self.boundary_cache_timeout)
+
+        return Page(paginator.Page(object_list, number, self))
+
+    def _boundary(self, number, queryset, ordering, boundaries):
+        """
+        Determines the keyset values of the last row before page ``number``
+        by skipping rows from the nearest known boundary or from the end.
+        ``boundaries`` maps page numbers to known keyset values.
+        """
+        index = (number - 1) * self.per_page - 1
+        reverse = reverse_ordering(ordering)
+
+        # (rows to skip, queryset) tuples, from the start and from the end
+        candidates = [(index, queryset)]
+        if not self.count_exceeded:
+            candidates.append((self.count - 1 - index, queryset.order_by(*reverse)))
+
+        lower = [n for n in boundaries if n < number]
+        if lower:
+            n = max(lower)
+            candidates.append((index - (n - 1) * self.per_page,
+                queryset.filter(keyset_filter(ordering, boundaries[n]))))
+
+        higher = [n for n in boundaries if n > number]
+        if higher:
+            n = min(higher)
+            candidates.append(((n - 1) * self.per_page - 2 - index,
+                queryset.order_by(*reverse).filter(
+                    keyset_filter(ordering, boundaries[n], reverse=True))))
+
+        offset, queryset = min(candidates, key=lambda candidate: candidate[0])
+        return list(queryset.values_list(
+            *[field.lstrip('-') for field in ordering])[offset])
+
 
 class Page(paginator.Page):
     """
@@ -94,20 +313,31 @@ class Page(paginator.Page):
                 {% endif %}
             {% endfor %}
         """
-        return filter_adjacent(self._generate_page_range())
+        # _generate_page_range never yields adjacent duplicates
+        return self._generate_page_range()
 
     def _generate_page_range(self):
+        """
+        Yields the pages at the start, at the end and around the current page
+        in ascending order, and ``None`` for every gap. Only the pages inside
+        these windows are visited, not all pages.
+        """
         num_pages = self.paginator.num_pages
+        # The last pages are unknown if counting stopped at the ceiling
+        exceeded = getattr(self.paginator, 'count_exceeded', False)
+        end = 0 if exceeded else PAGINATION['END']
 
-        for i in range(1, num_pages + 1):
-            if i <= PAGINATION['START']:
-                yield i
-
-            elif i > num_pages - PAGINATION['END']:
-                yield i
+        pages = set(range(1, min(PAGINATION['START'], num_pages) + 1))
+        pages.update(range(max(num_pages - end, 0) + 1, num_pages + 1))
+        pages.update(range(max(self.number - PAGINATION['AROUND'], 1),
+            min(self.number + PAGINATION['AROUND'], num_pages) + 1))
 
-            elif abs(self.number - i) <= PAGINATION['AROUND']:
-                yield i
-
-            else:
+        previous = 0
+        for i in sorted(pages):
+            if i > previous + 1:
                 yield None # Ellipsis marker
+            yield i
+            previous = i
+
+        if previous < num_pages or exceeded:
+            yield None
@@ -1,8 +1,15 @@
+import operator
 import re
 
 from django import template
+from django.db.models import FieldDoesNotExist, Q
 from django.db.models.deletion import Collector
 
+try:
+    from django.http import StreamingHttpResponse
+except ImportError: # Django < 1.5, HttpResponse streams iterators as well
+    from django.http import HttpResponse as StreamingHttpResponse
+
 
 def related_classes(instance):
     """
@@ -62,6 +69,140 @@ def safe_queryset_and(qs1, qs2):
     return res
 
 
+def field_is_indexed(model, name):
+    """
+    Returns whether the database can use an index when filtering or ordering
+    by the field ``name`` of ``model``: The field is the primary key, unique,
+    indexed itself (foreign keys are indexed by default) or the first field
+    of ``unique_together`` or ``index_together``.
+    """
+    opts = model._meta
+    f = opts.pk if name == 'pk' else opts.get_field(name)
+
+    if f.primary_key or f.unique or f.db_index:
+        return True
+
+    together = list(opts.unique_together) + list(getattr(opts, 'index_together', ()))
+    return any(fields and fields[0] == f.name for fields in together)
+
+
+def keyset_ordering(queryset, ordering=None):
+    """
+    Returns the ordering of ``queryset`` (or the explicitly passed ``ordering``)
+    as a list of field names suitable for keyset pagination. The primary key
+    is appended as a tie-breaker if it is not part of the ordering already.
+
+    Only plain fields of the model itself are supported, lookups spanning
+    relations, foreign keys (which Django orders by the ordering of the
+    related model), random ordering and ``extra()`` ordering raise a
+    ``ValueError``.
+    The ordering columns should not be nullable, and there should be an
+    index on them, otherwise keyset pagination is not any faster than
+    ``OFFSET``.
+    """
+    opts = queryset.model._meta
+
+    if ordering is None:
+        query = queryset.query
+        if query.extra_order_by:
+            raise ValueError('Keyset pagination does not support extra() ordering.')
+
+        ordering = list(query.order_by
+            or (query.default_ordering and opts.ordering)
+            or ())
+
+        if not query.standard_ordering:
+            ordering = reverse_ordering(ordering)
+
+    ordering = list(ordering)
+    pk_names = ('pk', opts.pk.name)
+
+    for field in ordering:
+        name = field.lstrip('-')
+        if name in pk_names:
+            continue
+
+        try:
+            f = opts.get_field(name)
+        except FieldDoesNotExist: # Relations, annotations, random ordering etc.
+            f = None
+
+        if f is None or f.rel:
+            raise ValueError(
+                'Keyset pagination does not support ordering by %r.' % field)
+
+    if not any(field.lstrip('-') in pk_names for field in ordering):
+        ordering.append('pk')
+
+    return ordering
+
+
+def reverse_ordering(ordering):
+    """
+    Reverses the direction of every field in ``ordering``
+    """
+    return [field[1:] if field.startswith('-') else '-%s' % field
+        for field in ordering]
+
+
+def keyset_values(instance, ordering):
+    """
+    Returns the values of the ordering fields of ``instance``, the position of
+    the instance inside a queryset ordered by ``ordering``.
+    """
+    opts = instance._meta
+    values = []
+    for field in ordering:
+        name = field.lstrip('-')
+        f = opts.pk if name == 'pk' else opts.get_field(name)
+        values.append(f.value_from_object(instance))
+    return values
+
+
+def keyset_filter(ordering, values, reverse=False):
+    """
+    Returns a ``Q`` object selecting all rows coming after the row with the
+    passed ``values`` when ordered by ``ordering``, or before the row if
+    ``reverse`` is ``True``. The row itself is never selected.
+
+    Usage::
+
+        ordering = keyset_ordering(queryset)
+        queryset = queryset.order_by(*ordering)
+        first = queryset[:20]
+        second = queryset.filter(keyset_filter(ordering,
+            keyset_values(list(first)[-1], ordering)))[:20]
+    """
+    clauses = []
+
+    for i, (field, value) in enumerate(zip(ordering, values)):
+        name = field.lstrip('-')
+        descending = field.startswith('-')
+        lookup = 'lt' if descending != reverse else 'gt'
+
+        clause = Q(**{'%s__%s' % (name, lookup): value})
+        for previous_field, previous_value in zip(ordering[:i], values[:i]):
+            clause &= Q(**{previous_field.lstrip('-'): previous_value})
+        clauses.append(clause)
+
+    return reduce(operator.or_, clauses)
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most ``size`` consecutive items from ``iterable``
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
 kwarg_re = re.compile("(?:(\w+)=)?(.+)")
 
 def parse_args_and_kwargs(parser, bits):